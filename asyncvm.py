@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+from basevm import OPCODES
+from bootcache import boot_vm
+from vm import ALIASES, VM
+
+DEFAULT_SLICE = 5000  # instructions executed between yields to the event loop
+
+
+def percentile(values: list[float], pct: float) -> float:
+    '''Nearest-rank percentile of the given values (0.0 if empty)'''
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = round(pct / 100 * (len(ordered) - 1))
+    return ordered[min(max(idx, 0), len(ordered) - 1)]
+
+
+@dataclass
+class SessionStats:
+    latencies: list[float] = field(default_factory=list)  # per send, in seconds
+    busy: float = 0.0  # time spent actually executing instructions
+    instructions: int = 0
+    slices: int = 0
+
+    @property
+    def p50(self):
+        return percentile(self.latencies, 50)
+
+    @property
+    def p99(self):
+        return percentile(self.latencies, 99)
+
+    def summary(self) -> str:
+        return (
+            f'{len(self.latencies)} cmds, {self.instructions} instrs, '
+            f'{self.slices} slices, busy {self.busy * 1000:.1f}ms, '
+            f'p50 {self.p50 * 1000:.2f}ms, p99 {self.p99 * 1000:.2f}ms'
+        )
+
+
+class AsyncVM:
+    '''Cooperative asyncio wrapper around a VM.
+
+    Execution yields to the event loop every `slice_size` instructions, so many
+    sessions can share one thread. Output is published as an async stream.
+    '''
+
+    def __init__(self, vm: VM, slice_size: int = DEFAULT_SLICE, name=None):
+        self.vm = vm
+        self.slice_size = slice_size
+        self.name = name
+        self.halted = False
+        self.stats = SessionStats()
+        self._output: asyncio.Queue[str | None] = asyncio.Queue()
+        self._lock = asyncio.Lock()
+
+    async def run(self) -> 'AsyncVM':
+        '''Run until halted or waiting for input, yielding between slices'''
+
+        vm = self.vm
+        async with self._lock:
+            while True:
+                start = time.perf_counter()
+                executed = 0
+                running = True
+                while executed < self.slice_size:
+                    if not vm.step():
+                        running = False
+                        break
+                    executed += 1
+
+                self.stats.busy += time.perf_counter() - start
+                self.stats.instructions += executed
+                self.stats.slices += 1
+                self._publish()
+
+                if not running:
+                    break
+                await asyncio.sleep(0)
+
+        # 'in' is the only instruction that pauses without halting
+        if OPCODES[vm.memory[vm.pc]].name != 'in':
+            self.close()
+        return self
+
+    async def send(self, cmd: str) -> 'AsyncVM':
+        '''Send a command and run until the VM needs more input'''
+
+        if ';' in cmd:
+            for subcmd in cmd.split(';'):
+                await self.send(subcmd.strip())
+            return self
+
+        # debug commands are cheap and synchronous
+        if cmd.startswith('.'):
+            self.vm.send(cmd)
+            self._publish()
+            return self
+
+        if self.halted:
+            raise RuntimeError(f'Session {self.name} has halted')
+
+        self.vm.input = list(ALIASES.get(cmd, cmd) + '\n')
+        start = time.perf_counter()
+        await self.run()
+        self.stats.latencies.append(time.perf_counter() - start)
+        return self
+
+    def read(self) -> str:
+        '''Return all output published so far without waiting'''
+
+        chunks = []
+        while not self._output.empty():
+            if (chunk := self._output.get_nowait()) is not None:
+                chunks.append(chunk)
+            else:
+                self._output.put_nowait(None)  # keep the stream closed
+                break
+        return ''.join(chunks)
+
+    async def stream(self) -> AsyncIterator[str]:
+        '''Yield output chunks as they are produced until the session closes'''
+
+        while (chunk := await self._output.get()) is not None:
+            yield chunk
+        self._output.put_nowait(None)
+
+    def close(self):
+        if not self.halted:
+            self.halted = True
+            self._output.put_nowait(None)
+
+    def reopen(self):
+        '''Resume a halted session (e.g. after restoring a snapshot), dropping
+        the end-of-stream marker but keeping unread output'''
+
+        pending = []
+        while not self._output.empty():
+            if (chunk := self._output.get_nowait()) is not None:
+                pending.append(chunk)
+        for chunk in pending:
+            self._output.put_nowait(chunk)
+        self.halted = False
+
+    def _publish(self):
+        if output := self.vm.read():
+            self._output.put_nowait(output)
+
+
+class Scheduler:
+    '''Drives many AsyncVM sessions in one event loop.
+
+    Each session yields after every slice, and asyncio runs ready tasks in FIFO
+    order, so sessions take turns round-robin. `max_active` optionally bounds
+    how many sessions may be executing commands at once.
+    '''
+
+    def __init__(self, max_active: int | None = None):
+        self.sessions: list[AsyncVM] = []
+        self._tasks: list[asyncio.Task] = []
+        self._sem = asyncio.Semaphore(max_active) if max_active else None
+
+    def spawn(self, session: AsyncVM, commands: list[str]) -> asyncio.Task:
+        self.sessions.append(session)
+        task = asyncio.create_task(self._drive(session, commands))
+        self._tasks.append(task)
+        return task
+
+    async def _drive(self, session: AsyncVM, commands: list[str]):
+        transcript = []
+        for cmd in commands:
+            if self._sem:
+                async with self._sem:
+                    await session.send(cmd)
+            else:
+                await session.send(cmd)
+            transcript.append(session.read())
+            if session.halted:
+                break
+        return transcript
+
+    async def join(self):
+        return await asyncio.gather(*self._tasks)
+
+    def report(self):
+        latencies = []
+        for session in self.sessions:
+            print(f'{session.name}: {session.stats.summary()}')
+            latencies += session.stats.latencies
+
+        print(
+            f'\033[93m{len(self.sessions)} sessions, {len(latencies)} cmds, '
+            f'p50 {percentile(latencies, 50) * 1000:.2f}ms, '
+            f'p99 {percentile(latencies, 99) * 1000:.2f}ms\033[0m'
+        )
+
+
+async def run_sessions(
+    vm: VM,
+    nsessions: int,
+    commands: list[str],
+    slice_size: int = DEFAULT_SLICE,
+    max_active: int | None = None,
+):
+    scheduler = Scheduler(max_active)
+    for i in range(nsessions):
+        session = AsyncVM(vm.clone(), slice_size, name=f'session-{i}')
+        scheduler.spawn(session, commands)
+
+    start = time.perf_counter()
+    await scheduler.join()
+    elapsed = time.perf_counter() - start
+
+    scheduler.report()
+    print(f'finished in {elapsed:.2f}s')
+    return scheduler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument('-n', '--sessions', type=int, default=100)
+    parser.add_argument(
+        '-c', '--commands', default='take tablet;use tablet;doorway;n;n'
+    )
+    parser.add_argument('-s', '--slice', type=int, default=DEFAULT_SLICE)
+    parser.add_argument('-m', '--max-active', type=int)
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    args = parser.parse_args()
+
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
+    vm.read()
+
+    commands = [cmd.strip() for cmd in args.commands.split(';')]
+    asyncio.run(
+        run_sessions(
+            vm, args.sessions, commands, args.slice, args.max_active
+        )
+    )
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -1,8 +1,15 @@
+import hashlib
 import re
+from array import array
 from dataclasses import dataclass
 from itertools import batched
+from pathlib import Path
 from typing import override
 
+ARCH_SPEC = Path(__file__).parent / 'arch-spec'
+# root of every on-disk cache, next to the sources wherever we're run from
+CACHE_ROOT = Path(__file__).parent / '.cache'
+
 
 @dataclass
 class Opcode:
@@ -28,7 +35,7 @@ def read_instruction(memory: list[int], addr: int):
     return opcode, args
 
 
-def parse_opcodes(arch_spec='arch-spec') -> dict[int, Opcode]:
+def parse_opcodes(arch_spec=ARCH_SPEC) -> dict[int, Opcode]:
     '''Parse opcodes and their expected arguments from the arch-spec document'''
 
     with open(arch_spec) as f:
@@ -42,7 +49,53 @@ def parse_opcodes(arch_spec='arch-spec') -> dict[int, Opcode]:
     return opcodes
 
 
-OPCODES = parse_opcodes()
+def verify_opcodes(arch_spec=ARCH_SPEC):
+    '''Check the built-in opcode table against the arch-spec document'''
+
+    parsed = parse_opcodes(arch_spec)
+    if parsed != OPCODES:
+        mismatched = [
+            (opid, OPCODES.get(opid), parsed.get(opid))
+            for opid in sorted(parsed.keys() | OPCODES.keys())
+            if OPCODES.get(opid) != parsed.get(opid)
+        ]
+        raise ValueError(
+            f'Opcode table does not match {arch_spec}: {mismatched}'
+        )
+
+
+# built-in copy of parse_opcodes() to avoid parsing arch-spec on every import
+OPCODES = {
+    0: Opcode('halt', 0, 0),
+    1: Opcode('set', 1, 2),
+    2: Opcode('push', 2, 1),
+    3: Opcode('pop', 3, 1),
+    4: Opcode('eq', 4, 3),
+    5: Opcode('gt', 5, 3),
+    6: Opcode('jmp', 6, 1),
+    7: Opcode('jt', 7, 2),
+    8: Opcode('jf', 8, 2),
+    9: Opcode('add', 9, 3),
+    10: Opcode('mult', 10, 3),
+    11: Opcode('mod', 11, 3),
+    12: Opcode('and', 12, 3),
+    13: Opcode('or', 13, 3),
+    14: Opcode('not', 14, 2),
+    15: Opcode('rmem', 15, 2),
+    16: Opcode('wmem', 16, 2),
+    17: Opcode('call', 17, 1),
+    18: Opcode('ret', 18, 0),
+    19: Opcode('out', 19, 1),
+    20: Opcode('in', 20, 1),
+    21: Opcode('noop', 21, 0),
+}
+
+
+def memory_hash(memory: list[int]) -> str:
+    '''Fast content hash of a memory image, used to key analysis caches'''
+
+    data = array('H', memory).tobytes()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
 def load_bytecode(binfile):
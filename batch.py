@@ -0,0 +1,217 @@
+'''Headless batch runner for command scripts.
+
+Runs every script in a directory (commands separated by newlines or `;`, like
+macros) across a process pool. Each worker starts its scripts from the same
+warm image (the booted VM, or a saved snapshot), which is sent to it once.
+Every script gets a transcript in the output directory, and its final state
+is saved to a snapshot repository there. Scripts which execute more than the
+instruction budget are stopped.
+'''
+import argparse
+import contextlib
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import override
+
+from macro_runner import read_macro
+from vm import VM, VMSnapshot
+
+DEFAULT_BUDGET = 10_000_000
+
+
+class BudgetExceeded(BaseException):
+    '''Not an Exception, so handlers for failing commands (like the one
+    around debug commands in VM.send) can't swallow it'''
+
+
+class CountingVM(VM):
+    '''VM which counts executed instructions and stops at a budget'''
+
+    # kept when a macro restores a checkpoint
+    SESSION_ATTRS = ('instructions', 'budget')
+
+    def __init__(self, *args, budget: int | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instructions = 0
+        self.budget = budget
+
+    @override
+    def execute(self, opcode, args):
+        if self.budget is not None and self.instructions >= self.budget:
+            raise BudgetExceeded(
+                f'instruction budget of {self.budget} exceeded'
+            )
+        self.instructions += 1
+        return super().execute(opcode, args)
+
+
+@dataclass
+class ScriptResult:
+    name: str
+    commands: int
+    instructions: int
+    elapsed: float
+    status: str  # 'ok', 'budget' or 'error'
+    error: str | None
+    snapshot: VMSnapshot
+
+
+# per-worker state, set by init_worker
+_image: VMSnapshot | None = None
+_budget: int | None = None
+
+
+def init_worker(image: VMSnapshot, budget: int | None):
+    global _image, _budget
+    _image, _budget = image, budget
+
+
+def run_script(script: Path, outdir: Path) -> ScriptResult:
+    '''Run one script from the warm image, writing its transcript'''
+
+    assert _image is not None, 'Worker was not initialized'
+    vm = CountingVM.from_snapshot(_image)
+    vm.budget = _budget
+    vm.read()
+
+    commands = []
+    status, error = 'ok', None
+    start = time.perf_counter()
+    try:
+        commands = read_macro(script)
+        with open(outdir / f'{script.name}.txt', 'w') as transcript:
+            for cmd in commands:
+                before = vm.instructions
+                printed = io.StringIO()  # aliases and debug command output
+                try:
+                    with contextlib.redirect_stdout(printed):
+                        vm.send(cmd)
+                except BudgetExceeded as exc:
+                    status, error = 'budget', str(exc)
+                except Exception as exc:
+                    status, error = 'error', repr(exc)
+
+                output = printed.getvalue() + vm.read()
+                if output and not output.endswith('\n'):
+                    output += '\n'  # cut short by an error
+                transcript.write(f'> {cmd}\n{output}')
+                transcript.write(
+                    f'# {vm.instructions - before} instructions\n'
+                )
+                if error:
+                    transcript.write(f'# stopped: {error}\n')
+                    break
+    except Exception as exc:
+        # reading the script or writing its transcript failed
+        status, error = 'error', repr(exc)
+
+    return ScriptResult(
+        name=script.name,
+        commands=len(commands),
+        instructions=vm.instructions,
+        elapsed=time.perf_counter() - start,
+        status=status,
+        error=error,
+        snapshot=vm.snapshot(),
+    )
+
+
+def run_batch(
+    image: VMSnapshot,
+    scripts: list[Path],
+    outdir: Path,
+    jobs: int | None = None,
+    budget: int | None = DEFAULT_BUDGET,
+) -> list[ScriptResult]:
+    '''Run scripts in parallel, saving each final state to the snapshot
+    repository in outdir and printing each result in order'''
+
+    from snapshot_repo import SnapshotRepo
+
+    outdir.mkdir(parents=True, exist_ok=True)
+    repo = SnapshotRepo(outdir / 'snapshots' / '.repo')
+
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=init_worker,
+        initargs=(image, budget),
+    ) as pool:
+        futures = [pool.submit(run_script, s, outdir) for s in scripts]
+        for future in futures:
+            result = future.result()
+            repo.save(result.name, result.snapshot)
+            results.append(result)
+
+            color = '92' if result.status == 'ok' else '91'
+            print(
+                f'\033[{color}m{result.status:<6}\033[0m {result.name:<24} '
+                f'{result.commands:>4} cmds {result.instructions:>12,} instrs '
+                f'{result.elapsed:>7.2f}s'
+                + (f'  ({result.error})' if result.error else '')
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scripts', type=Path, help='Directory of scripts')
+    parser.add_argument('-o', '--outdir', type=Path, default=Path('batch'))
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '-s',
+        '--snapshot',
+        help='Start scripts from this saved snapshot instead of after boot',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        help='Number of worker processes (default: one per CPU)',
+    )
+    parser.add_argument(
+        '-b',
+        '--budget',
+        type=int,
+        default=DEFAULT_BUDGET,
+        help='Stop a script after this many instructions (0 for no limit)',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    args = parser.parse_args()
+
+    if args.snapshot:
+        from snapshot_repo import SnapshotRepo
+        image = SnapshotRepo().load(args.snapshot)
+    else:
+        from bootcache import boot_vm
+        image = boot_vm(args.file, use_cache=not args.no_cache).snapshot()
+
+    scripts = sorted(p for p in args.scripts.iterdir() if p.is_file())
+    start = time.perf_counter()
+    results = run_batch(
+        image, scripts, args.outdir, args.jobs, args.budget or None
+    )
+    elapsed = time.perf_counter() - start
+
+    failed = sum(r.status != 'ok' for r in results)
+    instructions = sum(r.instructions for r in results)
+    print(
+        f'\033[93m{len(results)} scripts in {elapsed:.2f}s '
+        f'({len(results) / elapsed:.1f} scripts/sec), '
+        f'{instructions:,} instrs, {failed} stopped\033[0m'
+    )
+    print(f'transcripts and snapshots written to {args.outdir}')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,96 @@
+'''Import-time benchmark for the entry-point modules.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter for
+each module, summarizes the slowest imports, and exits non-zero if a module
+exceeds its time budget or pulls in a dependency that should be lazy. Each
+module is timed over several runs and judged by its fastest, since single
+runs vary by tens of milliseconds with the load on the machine.
+'''
+import argparse
+import re
+import subprocess
+import sys
+
+MODULES = [
+    'basevm',
+    'vm',
+    'disassembler',
+    'bootcache',
+    'strings',
+    'run',
+    'solve_all',
+    'solve_coins',
+    'asyncvm',
+]
+
+# dependencies which must only be imported when actually used
+LAZY_MODULES = ['matplotlib', 'networkx', 'pyvis', 'readline', 'z3', 'numpy']
+
+DEFAULT_BUDGET_MS = 100
+DEFAULT_RUNS = 5
+
+
+def import_times(module: str) -> list[tuple[str, int, int]]:
+    '''Returns (name, self_us, cumulative_us) for each module imported'''
+
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return [
+        (name.strip(), int(self_us), int(cumulative))
+        for self_us, cumulative, name in re.findall(
+            r'import time:\s+(\d+) \|\s+(\d+) \|(.*)', proc.stderr
+        )
+    ]
+
+
+def cumulative_us(times: list[tuple[str, int, int]], module: str) -> int:
+    return next(c for name, _, c in times if name == module)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('-b', '--budget', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument(
+        '-n',
+        '--runs',
+        type=int,
+        default=DEFAULT_RUNS,
+        help='Time each module this many times, keeping the fastest run',
+    )
+    parser.add_argument('-t', '--top', type=int, default=3)
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(max(args.runs, 1))]
+        times = min(runs, key=lambda times: cumulative_us(times, module))
+        total_ms = cumulative_us(times, module) / 1000
+        slowest = sorted(times, key=lambda t: t[1], reverse=True)[:args.top]
+        lazy = sorted({
+            name for name, _, _ in times
+            if name.split('.')[0] in LAZY_MODULES
+        })
+
+        ok = total_ms <= args.budget and not lazy
+        status = '✅' if ok else '❌'
+        print(f'{status} {module}: {total_ms:.1f}ms')
+        for name, self_us, _ in slowest:
+            print(f'     {self_us / 1000:6.1f}ms  {name}')
+
+        if total_ms > args.budget:
+            failures.append(f'{module} took {total_ms:.1f}ms')
+        if lazy:
+            failures.append(f'{module} eagerly imports {", ".join(lazy)}')
+
+    for failure in failures:
+        print(f'\033[91m{failure}\033[0m')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+from basevm import CACHE_ROOT
+from vm import VM, file_hash
+
+CACHE_DIR = CACHE_ROOT / 'boot'
+
+# sources whose behavior affects the booted state
+INTERPRETER_FILES = ['basevm.py', 'vm.py']
+
+
+def interpreter_version() -> str:
+    h = hashlib.sha256()
+    for fname in INTERPRETER_FILES:
+        h.update((Path(__file__).parent / fname).read_bytes())
+    return h.hexdigest()[:16]
+
+
+def cache_path(binfile: str | Path) -> Path:
+    key = f'{file_hash(binfile)[:32]}-{interpreter_version()}'
+    return CACHE_DIR / f'{key}.pickle'
+
+
+def prune_cache(path: Path):
+    '''Delete the entries for the same binary as path which were booted by
+    other interpreter versions'''
+
+    binary_key = path.name.split('-')[0]
+    for old in CACHE_DIR.glob(f'{binary_key}-*.pickle'):
+        if old != path:
+            old.unlink(missing_ok=True)
+
+
+def boot_vm(binfile: str | Path = 'challenge.bin', use_cache=True) -> VM:
+    '''Return a VM for the given binary which has been run up to its first
+    input prompt (past the self-test), loading it from the boot cache when
+    possible. The boot output is left unread in the VM.'''
+
+    if not use_cache:
+        return VM(binfile).run()
+
+    path = cache_path(binfile)
+    if path.exists():
+        try:
+            with open(path, 'rb') as f:
+                return VM.from_snapshot(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            pass  # corrupt or outdated entry, rebuild it below
+
+    vm = VM(binfile).run()
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f'.tmp{os.getpid()}')
+    with open(tmp, 'wb') as f:
+        pickle.dump(vm.snapshot(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp.replace(path)
+    prune_cache(path)
+    return vm
+
+
+def clear_cache():
+    for path in CACHE_DIR.glob('*.pickle'):
+        path.unlink()
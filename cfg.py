@@ -0,0 +1,333 @@
+'''Recursive-descent control-flow analysis of VM memory.
+
+Starting from a set of entry points, every reachable instruction is decoded
+once, then split into basic blocks connected by jmp/jt/jf/call/ret edges.
+Call targets become function entries, and every word not covered by a
+reachable instruction is classified as data. Results are cached per memory
+hash, so tools inspecting the same image share a single analysis.
+'''
+import argparse
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from basevm import OPCODES, Opcode, is_reg, memory_hash
+from disassembler import iter_instructions
+
+DATA, CODE, OPERAND = 0, 1, 2  # values of Analysis.kinds
+
+BRANCHES = {'jmp', 'jt', 'jf'}
+WRITES_REG = {
+    'set', 'eq', 'gt', 'add', 'mult', 'mod', 'and', 'or', 'not', 'rmem',
+    'pop', 'in'
+}
+BLOCK_ENDS = {'jmp', 'jt', 'jf', 'call', 'ret', 'halt'}
+NO_FALLTHROUGH = {'jmp', 'ret', 'halt'}
+CALL = next(op.id for op in OPCODES.values() if op.name == 'call')
+
+CACHE_SIZE = 8
+
+
+@dataclass
+class BasicBlock:
+    start: int
+    end: int  # address following the last instruction
+    instructions: list[int]
+    successors: list[tuple[int, str]] = field(default_factory=list)
+
+    @property
+    def last(self):
+        return self.instructions[-1]
+
+
+@dataclass
+class Function:
+    entry: int
+    blocks: list[int]  # block start addresses, sorted
+    calls: set[int] = field(default_factory=set)
+    returns: list[int] = field(default_factory=list)  # addresses of rets
+
+
+@dataclass
+class Analysis:
+    instructions: dict[int, tuple[Opcode, tuple[int, ...]]]
+    blocks: dict[int, BasicBlock]
+    block_of: dict[int, int]  # instruction address => block start
+    functions: dict[int, Function]
+    kinds: bytearray  # DATA, CODE or OPERAND for every word in memory
+    indirect: list[int]  # addresses of unresolved jumps/calls via registers
+    invalid: list[int]  # reachable addresses which don't decode
+
+    @property
+    def edges(self):
+        for block in self.blocks.values():
+            for dst, kind in block.successors:
+                yield block.start, dst, kind
+
+    def is_code(self, addr: int) -> bool:
+        return self.kinds[addr] != DATA
+
+    def function_of(self, addr: int) -> list[int]:
+        '''Entries of the functions containing the given address'''
+
+        start = self.block_of.get(addr)
+        return [
+            f.entry for f in self.functions.values() if start in f.blocks
+        ]
+
+    def data_ranges(self):
+        '''Yields (start, end) for each contiguous run of data words'''
+
+        start = None
+        for addr, kind in enumerate(self.kinds):
+            if kind == DATA and start is None:
+                start = addr
+            elif kind != DATA and start is not None:
+                yield start, addr
+                start = None
+        if start is not None:
+            yield start, len(self.kinds)
+
+
+_cache: OrderedDict[tuple, Analysis] = OrderedDict()
+
+
+def analyze(
+    memory: list[int],
+    entries: tuple[int, ...] = (0, ),
+    sweep_calls=False,
+) -> Analysis:
+    '''Analyze memory from the given entry points, using a cached result if
+    the same memory image was analyzed before.
+
+    With sweep_calls, the constant targets of calls found by a linear sweep are
+    used as extra entry points, which discovers functions only reachable
+    through indirect calls. Without it, code reached through function
+    pointers is missed and `kinds`/`is_code` label it as data.'''
+
+    key = (memory_hash(memory), tuple(entries), sweep_calls)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    entries = tuple(entries)
+    if sweep_calls:
+        entries += tuple(
+            args[0] for _, opcode, args in iter_instructions(memory)
+            if opcode and opcode.name == 'call' and not is_reg(args[0])
+        )
+
+    result = _analyze(memory, entries)
+    _cache[key] = result
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return result
+
+
+def analyze_vm(vm, sweep_calls=True) -> Analysis:
+    '''Analyze from address 0, the current pc and the pending return addresses
+    on the stack (sweeping for call targets unless told not to)'''
+
+    # stack values which directly follow a call instruction are return sites
+    returns = [
+        addr for addr in vm.stack
+        if 2 <= addr < len(vm.memory) and vm.memory[addr - 2] == CALL
+    ]
+    return analyze(vm.memory, (0, vm.pc, *returns), sweep_calls)
+
+
+def _analyze(memory: list[int], entries: tuple[int, ...]) -> Analysis:
+    size = len(memory)
+    kinds = bytearray(size)
+    instructions = {}
+    leaders = set()
+    func_entries = []
+    resolved = {}  # register jump/call address => constant target
+    indirect = []
+    invalid = []
+
+    valid_entries = [addr for addr in entries if 0 <= addr < size]
+    leaders.update(valid_entries)
+    func_entries.extend(valid_entries)
+
+    # decode every reachable instruction once
+    todo = list(valid_entries)
+    while todo:
+        addr = todo.pop()
+        consts = {}  # registers holding known constants in this straight run
+        while addr not in instructions:
+            if addr in leaders:
+                consts.clear()
+
+            opcode = OPCODES.get(memory[addr])
+            if opcode is None or addr + len(opcode) > size:
+                invalid.append(addr)
+                break
+
+            name = opcode.name
+            next_addr = addr + len(opcode)
+            args = tuple(memory[addr + 1:next_addr])
+            instructions[addr] = opcode, args
+            kinds[addr] = CODE
+            kinds[addr + 1:next_addr] = bytes([OPERAND]) * opcode.nargs
+
+            if name in BRANCHES or name == 'call':
+                target = args[-1] if name != 'call' else args[0]
+                if is_reg(target) and target in consts:
+                    target = resolved[addr] = consts[target]
+                if is_reg(target):
+                    indirect.append(addr)
+                elif target < size:
+                    leaders.add(target)
+                    todo.append(target)
+                    if name == 'call':
+                        func_entries.append(target)
+
+            if name == 'set' and not is_reg(args[1]):
+                consts[args[0]] = args[1]
+            elif name in WRITES_REG:
+                consts.pop(args[0], None)
+            elif name == 'call':
+                consts.clear()
+
+            if name in BLOCK_ENDS:
+                leaders.add(next_addr)
+            if name in NO_FALLTHROUGH or next_addr >= size:
+                break
+            addr = next_addr
+
+    blocks, block_of = _build_blocks(instructions, leaders, resolved)
+    functions = _build_functions(blocks, block_of, instructions, func_entries)
+
+    # ret edges lead back to the return sites of each function's callers
+    return_sites: dict[int, list[int]] = {}
+    for block in blocks.values():
+        for dst, kind in block.successors:
+            if kind == 'call':
+                return_sites.setdefault(dst, []).append(block.end)
+    for func in functions.values():
+        for ret in func.returns:
+            blocks[block_of[ret]].successors.extend(
+                (site, 'ret') for site in return_sites.get(func.entry, [])
+            )
+
+    return Analysis(
+        instructions=instructions,
+        blocks=blocks,
+        block_of=block_of,
+        functions=functions,
+        kinds=kinds,
+        indirect=sorted(indirect),
+        invalid=sorted(set(invalid)),
+    )
+
+
+def _build_blocks(instructions, leaders, resolved):
+    blocks: dict[int, BasicBlock] = {}
+    block_of: dict[int, int] = {}
+    block = None
+
+    for addr in sorted(instructions):
+        opcode, args = instructions[addr]
+        if block is None or addr in leaders or addr != block.end:
+            block = blocks[addr] = BasicBlock(addr, addr, [])
+
+        block.instructions.append(addr)
+        block.end = addr + len(opcode)
+        block_of[addr] = block.start
+
+        if opcode.name in BLOCK_ENDS:
+            block = None
+
+    for block in blocks.values():
+        opcode, args = instructions[block.last]
+        name = opcode.name
+        target = resolved.get(block.last, args[-1] if args else 0)
+        if name in BRANCHES and not is_reg(target):
+            block.successors.append((target, name))
+        elif name == 'call' and not is_reg(target):
+            block.successors.append((target, 'call'))
+        if name not in NO_FALLTHROUGH and block.end in instructions:
+            block.successors.append((block.end, 'fallthrough'))
+
+    return blocks, block_of
+
+
+def _build_functions(blocks, block_of, instructions, entries):
+    functions = {}
+    for entry in entries:
+        if entry in functions or entry not in block_of:
+            continue
+
+        # follow intra-procedural edges only (calls return to the next block)
+        seen = set()
+        todo = [block_of[entry]]
+        func = Function(entry, [])
+        while todo:
+            start = todo.pop()
+            if start in seen or start not in blocks:
+                continue
+            seen.add(start)
+            block = blocks[start]
+            opcode, args = instructions[block.last]
+            if opcode.name == 'ret':
+                func.returns.append(block.last)
+            for dst, kind in block.successors:
+                if kind == 'call':
+                    func.calls.add(dst)
+                elif kind != 'ret':
+                    todo.append(block_of.get(dst, dst))
+
+        func.blocks = sorted(seen)
+        func.returns.sort()
+        functions[entry] = func
+    return functions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    parser.add_argument(
+        '--no-sweep-calls',
+        action='store_true',
+        help='Only follow code reachable from the entry points',
+    )
+    parser.add_argument('-F', '--functions', action='store_true')
+    args = parser.parse_args()
+
+    from bootcache import boot_vm
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
+
+    start = time.perf_counter()
+    result = analyze_vm(vm, not args.no_sweep_calls)
+    elapsed = time.perf_counter() - start
+
+    code = sum(1 for kind in result.kinds if kind != DATA)
+    print(
+        f'{len(result.instructions)} instructions, {len(result.blocks)} '
+        f'blocks, {sum(1 for _ in result.edges)} edges, '
+        f'{len(result.functions)} functions, {code} code words, '
+        f'{len(result.kinds) - code} data words '
+        f'({len(result.indirect)} indirect, {len(result.invalid)} invalid) '
+        f'in {elapsed * 1000:.1f}ms'
+    )
+
+    if args.functions:
+        for func in sorted(result.functions.values(), key=lambda f: f.entry):
+            calls = ' '.join(map(str, sorted(func.calls)))
+            print(
+                f'{func.entry:>5}  {len(func.blocks)} blocks, '
+                f'{len(func.returns)} rets, calls: {calls}'
+            )
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,336 @@
+'''Lockstep differential testing of VM engines.
+
+Runs a reference BaseVM and a candidate engine side by side from the same
+start state, feeding both the same commands. Every `every` steps their pc,
+registers, stack and output are compared, and their memory hashes are compared
+at sync points (every SYNC_INTERVAL steps, and whenever both wait for input).
+A candidate which raises also counts as a mismatch. On a mismatch, both
+engines rewind to the start of the command and replay it comparing the full
+state after every instruction, to report the first instruction whose effects
+differ along with a disassembly window around it.
+
+Candidates are classes with BaseVM's interface (`step()` executes one
+instruction, and state lives in memory/registers/stack/pc/input/output),
+given as `module:Class`. Start states come from a corpus built by playing
+`macros/full-solution` (boot, each map phase and the teleporter), cached per
+binary under `.cache/difftest`.
+'''
+import argparse
+import importlib
+import pickle
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from basevm import (
+    CACHE_ROOT, BaseVM, Registers, memory_hash, read_instruction
+)
+from vm import VMSnapshot
+
+CORPUS_DIR = CACHE_ROOT / 'difftest'
+CORPUS_MACRO = Path(__file__).parent / 'macros' / 'full-solution'
+DEFAULT_EVERY = 64
+SYNC_INTERVAL = 4096  # steps between memory hash comparisons
+MAX_STEPS = 10_000_000  # per command
+
+# corpus entries start before these commands of the full solution macro
+# (the second teleport needs the teleporter patch, so starts after it)
+CORPUS_PHASES = {
+    'boot': 0,
+    'maze': 20,
+    'ruins': 28,
+    'teleporter': 48,
+    'beach': 54,
+    'vault': 63,
+}
+
+
+@dataclass
+class CorpusEntry:
+    name: str
+    snapshot: VMSnapshot
+    commands: list[str]
+
+
+@dataclass
+class Divergence:
+    entry: str
+    command_idx: int
+    command: str
+    step: int  # instructions into the command
+    pc: int
+    instruction: str
+    differences: dict[str, tuple] = field(default_factory=dict)
+    window: list[str] = field(default_factory=list)
+
+    def report(self) -> str:
+        lines = [
+            f'\033[91mDIVERGED in {self.entry} at command '
+            f'#{self.command_idx} "{self.command}", step {self.step} '
+            f'(pc {self.pc}: {self.instruction})\033[0m'
+        ]
+        for key, (ref, cand) in self.differences.items():
+            lines.append(f'  {key}: reference {ref} != candidate {cand}')
+        lines += self.window
+        return '\n'.join(lines)
+
+
+# ============
+# Engine State
+# ============
+
+
+def load_engine(spec: str) -> type:
+    '''Import an engine class given as module:Class'''
+
+    module, _, name = spec.partition(':')
+    assert name, f'Expected module:Class, got {spec!r}'
+    return getattr(importlib.import_module(module), name)
+
+
+def load_state(vm, snapshot: VMSnapshot):
+    if hasattr(vm, 'apply_snapshot'):
+        vm.apply_snapshot(snapshot)
+        return vm
+    vm.memory = list(snapshot['memory'])
+    vm.stack = list(snapshot['stack'])
+    vm.registers = Registers(list(snapshot['registers']))
+    vm.pc = snapshot['pc']
+    vm.input = list(snapshot['input'])
+    vm.output = snapshot['output']
+    return vm
+
+
+def capture(vm) -> VMSnapshot:
+    return {
+        'memory': list(vm.memory),
+        'stack': list(vm.stack),
+        'registers': list(vm.registers),
+        'pc': vm.pc,
+        'input': list(vm.input),
+        'output': vm.output,
+        'location_addr': None,
+        'binary_hash': None,
+    }
+
+
+def compare(ref, cand, memory=False) -> dict[str, tuple]:
+    differences = {}
+    for key in ('pc', 'registers', 'stack', 'output'):
+        r, c = getattr(ref, key), getattr(cand, key)
+        if key in ('registers', 'stack'):
+            r, c = list(r), list(c)
+        if r != c:
+            differences[key] = (r, c)
+
+    if memory and memory_hash(ref.memory) != memory_hash(cand.memory):
+        addrs = [
+            i for i, (r, c) in enumerate(zip(ref.memory, cand.memory))
+            if r != c
+        ]
+        if len(ref.memory) != len(cand.memory):
+            differences['memory size'] = (len(ref.memory), len(cand.memory))
+        for addr in addrs[:8]:
+            differences[f'memory[{addr}]'] = (
+                ref.memory[addr], cand.memory[addr]
+            )
+    return differences
+
+
+# ========
+# Lockstep
+# ========
+
+
+@dataclass
+class Mismatch:
+    step: int
+    pc: int  # of the instruction executed at that step
+    differences: dict[str, tuple]
+
+
+def run_command(ref, cand, cmd: str, every: int, exact=False):
+    '''Step both engines through one command, returning the number of
+    steps executed or the first mismatch found. Unless exact, registers,
+    stack and output are only compared every `every` steps and memory only
+    at sync points.'''
+
+    ref.input = list(cmd + '\n')
+    cand.input = list(cmd + '\n')
+
+    for step in range(1, MAX_STEPS + 1):
+        pc = ref.pc
+        ref_running = ref.step()
+        try:
+            cand_running = cand.step()
+        except Exception as exc:
+            return Mismatch(step, pc, {'exception': (None, repr(exc))})
+
+        paused = not ref_running and not cand_running
+        sync = exact or paused or step % SYNC_INTERVAL == 0
+        if sync or step % every == 0:
+            if differences := compare(ref, cand, memory=sync):
+                return Mismatch(step, pc, differences)
+        if ref_running != cand_running:
+            return Mismatch(step, pc, {'running': (ref_running, cand_running)})
+        if paused:
+            return step
+
+    raise RuntimeError(f'"{cmd}" did not finish in {MAX_STEPS} steps')
+
+
+def run_entry(
+    entry: CorpusEntry,
+    engine: type,
+    every=DEFAULT_EVERY,
+) -> int | Divergence:
+    '''Run a corpus entry on the reference and the candidate engine,
+    returning the number of steps executed or the first divergence'''
+
+    ref = load_state(BaseVM(), entry.snapshot)
+    cand = load_state(engine(), entry.snapshot)
+
+    steps = 0
+    for idx, cmd in enumerate(entry.commands):
+        start = capture(ref), capture(cand)
+        result = run_command(ref, cand, cmd, every)
+        if isinstance(result, int):
+            steps += result
+            ref.output = cand.output = ''
+            continue
+
+        # rewind and replay one instruction at a time to find the first
+        # instruction whose effects differ
+        load_state(ref, start[0])
+        load_state(cand, start[1])
+        result = run_command(ref, cand, cmd, every, exact=True)
+        assert isinstance(result, Mismatch), 'Engines diverged only once'
+        return divergence(entry.name, idx, cmd, result, ref.memory)
+    return steps
+
+
+def divergence(entry: str, idx: int, cmd: str, mismatch: Mismatch, memory):
+    from disassembler import disassemble_window, format_instruction_plain
+
+    pc = mismatch.pc
+    instruction = format_instruction_plain(*read_instruction(memory, pc))
+    window = [
+        ('>> ' if line.split()[0] == str(pc) else '   ') + line
+        for line in disassemble_window(memory, pc, 5, 5)
+    ]
+    return Divergence(
+        entry, idx, cmd, mismatch.step, pc, instruction,
+        mismatch.differences, window
+    )
+
+
+# ======
+# Corpus
+# ======
+
+
+def build_corpus(binfile='challenge.bin', use_cache=True) -> list[CorpusEntry]:
+    '''Start states and the game commands following them, from playing the
+    full solution macro (cached per binary and interpreter version)'''
+
+    from bootcache import boot_vm, interpreter_version
+    from macro_runner import read_macro
+    from vm import file_hash
+
+    path = CORPUS_DIR / (
+        f'{file_hash(binfile)[:32]}-{interpreter_version()}.pickle'
+    )
+    if use_cache and path.exists():
+        with open(path, 'rb') as f:
+            return [CorpusEntry(*entry) for entry in pickle.load(f)]
+
+    commands = read_macro(CORPUS_MACRO)
+    vm = boot_vm(binfile, use_cache)
+    vm.read()
+
+    starts = sorted(CORPUS_PHASES.items(), key=lambda p: p[1])
+    ends = [start for _, start in starts[1:]] + [len(commands)]
+    corpus = []
+    pos = 0
+    for (name, start), end in zip(starts, ends):
+        for cmd in commands[pos:start]:
+            vm.send(cmd)
+        pos = start
+        vm.read()
+
+        # debug commands (like the teleporter patch) end the entry
+        game = []
+        for cmd in commands[start:end]:
+            if cmd.startswith('.'):
+                break
+            game.append(cmd)
+        corpus.append(CorpusEntry(name, vm.snapshot(), game))
+
+    CORPUS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        # plain tuples, so the cache loads whether or not this runs as __main__
+        entries = [(e.name, e.snapshot, e.commands) for e in corpus]
+        pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-e',
+        '--engine',
+        default='vm:VM',
+        help='Candidate engine class as module:Class',
+    )
+    parser.add_argument(
+        '-k',
+        '--every',
+        type=int,
+        default=DEFAULT_EVERY,
+        help='Compare registers, stack and output every K steps',
+    )
+    parser.add_argument(
+        'entries',
+        nargs='*',
+        help=f'Corpus entries to run (default: all of {list(CORPUS_PHASES)})',
+    )
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Rebuild the corpus (and boot) from scratch',
+    )
+    args = parser.parse_args()
+
+    engine = load_engine(args.engine)
+    corpus = build_corpus(args.file, use_cache=not args.no_cache)
+    unknown = set(args.entries) - {e.name for e in corpus}
+    assert not unknown, f'Unknown corpus entries: {sorted(unknown)}'
+
+    diverged = False
+    for entry in corpus:
+        if args.entries and entry.name not in args.entries:
+            continue
+        start = time.perf_counter()
+        result = run_entry(entry, engine, args.every)
+        elapsed = time.perf_counter() - start
+        if isinstance(result, Divergence):
+            print(result.report())
+            diverged = True
+        else:
+            print(
+                f'\033[92mok\033[0m {entry.name:<12} '
+                f'{len(entry.commands):>3} cmds {result:>9,} steps '
+                f'{elapsed:.2f}s'
+            )
+
+    if diverged:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
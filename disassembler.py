@@ -1,8 +1,12 @@
 import argparse
 import string
-from typing import Callable
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterator
 
-from basevm import OPCODES, Opcode, is_reg, read_instruction
+from basevm import OPCODES, Opcode, is_reg, memory_hash, read_instruction
 
 InstructionFormatter = Callable[[Opcode, tuple[int, ...] | tuple[str]], str]
 
@@ -63,6 +67,9 @@ def format_instruction_sensible(opcode, args):
 
 DEFAULT_FORMATTER = format_instruction_plain
 
+CHUNK_LINES = 4096  # lines buffered per write by write_disassembly
+CACHE_SIZE = 4
+
 
 def disassemble(
     memory: list[int],
@@ -79,31 +86,35 @@ def disassemble_lines(
     addr=0,
     lines: int = 0,
     format_instruction: InstructionFormatter = DEFAULT_FORMATTER,
-):
-    results = []
+    end: int | None = None,
+) -> Iterator[str]:
+    '''Lazily yields one formatted line per instruction (or invalid word),
+    stopping before the end address if one is given'''
+
+    end = len(memory) if end is None else min(end, len(memory))
     lines = lines or len(memory)
-    while addr < len(memory) and lines > 0:
+    while addr < end and lines > 0:
         try:
             opcode, args = read_instruction(memory, addr)
             curaddr = addr
 
             # combine multiple character outputs into one string
             if opcode.name == 'out' and not is_reg(args[0]):
-                outstring = chr(args[0])
+                chars = [chr(args[0])]
                 next_addr = addr + len(opcode)
-                while True:
+                while next_addr < end:
                     next_opcode, next_args = read_instruction(
                         memory, next_addr
                     )
                     if next_opcode.name != 'out' or is_reg(next_args[0]):
                         break
 
-                    outstring += chr(next_args[0])
+                    chars.append(chr(next_args[0]))
                     addr = next_addr
                     next_addr += len(opcode)
-                args = (outstring, )
+                args = (''.join(chars), )
 
-            results.append(f"{curaddr:>5}  {format_instruction(opcode, args)}")
+            yield f"{curaddr:>5}  {format_instruction(opcode, args)}"
             addr += len(opcode)
             lines -= 1
 
@@ -113,10 +124,83 @@ def disassemble_lines(
                 val = repr(chr(val)) + f' [{val}]'
             else:
                 val = f'[{val}]'
-            results.append(f'{addr:>5}  err {val}')
+            yield f'{addr:>5}  err {val}'
+            addr += 1
+
+
+def write_disassembly(
+    memory: list[int],
+    fname: str | Path,
+    addr=0,
+    lines: int = 0,
+    format_instruction: InstructionFormatter = DEFAULT_FORMATTER,
+):
+    '''Stream a disassembly listing to a file in buffered chunks'''
+
+    stream = disassemble_lines(memory, addr, lines, format_instruction)
+    with open(fname, 'w') as f:
+        while chunk := list(islice(stream, CHUNK_LINES)):
+            f.write('\n'.join(chunk) + '\n')
+
+
+_starts_cache: OrderedDict[str, list[int]] = OrderedDict()
+
+
+def instruction_starts(memory: list[int]) -> list[int]:
+    '''Sorted addresses of every instruction boundary, cached per memory
+    image. Reachable code found by control-flow analysis takes precedence, and
+    a linear sweep fills the gaps without running over known code.'''
+
+    key = memory_hash(memory)
+    if key in _starts_cache:
+        _starts_cache.move_to_end(key)
+        return _starts_cache[key]
+
+    from cfg import analyze
+    code = analyze(memory, sweep_calls=True).instructions
+
+    starts = []
+    addr = 0
+    while addr < len(memory):
+        starts.append(addr)
+        if addr in code:
+            addr += len(code[addr][0])
+        elif (opcode := OPCODES.get(memory[addr])) is not None and not any(
+            a in code for a in range(addr + 1, addr + len(opcode))
+        ):
+            addr += len(opcode)
+        else:
             addr += 1
 
-    return results
+    _starts_cache[key] = starts
+    if len(_starts_cache) > CACHE_SIZE:
+        _starts_cache.popitem(last=False)
+    return starts
+
+
+def align(memory: list[int], addr: int) -> int:
+    '''Start of the instruction containing the given address'''
+
+    starts = instruction_starts(memory)
+    return starts[max(bisect_right(starts, addr) - 1, 0)]
+
+
+def disassemble_window(
+    memory: list[int],
+    addr: int,
+    before: int = 5,
+    after: int = 10,
+    format_instruction: InstructionFormatter = DEFAULT_FORMATTER,
+) -> Iterator[str]:
+    '''Disassemble the instructions surrounding an arbitrary address, from
+    `before` instruction starts ahead of it up to `after` starts past it
+    (however many lines that takes, e.g. with runs of `out` combined)'''
+
+    starts = instruction_starts(memory)
+    idx = max(bisect_right(starts, addr) - 1, 0)
+    start = starts[max(idx - before, 0)]
+    end = starts[idx + after + 1] if idx + after + 1 < len(starts) else None
+    return disassemble_lines(memory, start, 0, format_instruction, end)
 
 
 def iter_instructions(memory: list[int]):
@@ -134,12 +218,33 @@ def iter_instructions(memory: list[int]):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    parser.add_argument('-a', '--addr', type=int, default=0)
+    parser.add_argument('-n', '--lines', type=int, default=0)
+    parser.add_argument(
+        '-w',
+        '--window',
+        action='store_true',
+        help='Disassemble --lines instructions around --addr',
+    )
+    parser.add_argument('-o', '--output', help='Write the listing to a file')
     args = parser.parse_args()
 
-    from vm import VM
-    vm = VM(args.file).run()
+    from bootcache import boot_vm
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
 
-    disassemble(vm.memory)
+    if args.window:
+        half = (args.lines or 20) // 2
+        for line in disassemble_window(vm.memory, args.addr, half, half):
+            print(line)
+    elif args.output:
+        write_disassembly(vm.memory, args.output, args.addr, args.lines)
+    else:
+        disassemble(vm.memory, args.addr, args.lines)
 
 
 if __name__ == '__main__':
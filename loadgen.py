@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import time
+
+from asyncvm import percentile
+from bootcache import boot_vm
+from server import start_server
+
+DEFAULT_SCRIPT = 'take tablet;use tablet;doorway;north;north;!snapshot;bridge;!restore;look'
+
+
+async def read_response(reader: asyncio.StreamReader) -> str:
+    if not (header := await reader.readline()):
+        raise ConnectionError('server closed the connection')
+    return (await reader.readexactly(int(header))).decode()
+
+
+async def client(host: str, port: int, commands: list[str]):
+    '''Run one session, returning the latency of each command'''
+
+    reader, writer = await asyncio.open_connection(host, port)
+    latencies = []
+    try:
+        await read_response(reader)  # boot output
+        for cmd in commands:
+            start = time.perf_counter()
+            writer.write(f'{cmd}\n'.encode())
+            await writer.drain()
+            await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+        writer.write(b'!quit\n')
+        await writer.drain()
+    finally:
+        writer.close()
+    return latencies
+
+
+async def generate_load(
+    host: str,
+    port: int,
+    commands: list[str],
+    sessions: int,
+    concurrency: int,
+):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with sem:
+            return await client(host, port, commands)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited() for _ in range(sessions)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [lat for result in results for lat in result]
+    print(
+        f'\033[93m{sessions} sessions in {elapsed:.2f}s '
+        f'({sessions / elapsed:.1f} sessions/sec), {len(latencies)} cmds, '
+        f'p50 {percentile(latencies, 50) * 1000:.2f}ms, '
+        f'p99 {percentile(latencies, 99) * 1000:.2f}ms\033[0m'
+    )
+    return latencies
+
+
+async def run(args):
+    commands = [cmd.strip() for cmd in args.commands.split(';')]
+    host, port = args.host, args.port
+
+    server = None
+    if args.spawn:
+        vm = boot_vm(args.file, use_cache=not args.no_cache)
+        server, game = await start_server(
+            vm, host, 0, pool_size=args.concurrency
+        )
+        host, port = server.sockets[0].getsockname()[:2]
+        print(f'Spawned server on {host}:{port}')
+
+    try:
+        await generate_load(
+            host, port, commands, args.sessions, args.concurrency
+        )
+    finally:
+        if server:
+            server.close()
+            game.report()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    parser.add_argument('-n', '--sessions', type=int, default=200)
+    parser.add_argument('-j', '--concurrency', type=int, default=32)
+    parser.add_argument('-c', '--commands', default=DEFAULT_SCRIPT)
+    parser.add_argument(
+        '--spawn',
+        action='store_true',
+        help='Start an in-process server instead of connecting to one',
+    )
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
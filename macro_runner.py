@@ -0,0 +1,216 @@
+'''Macro replay with prefix checkpoints.
+
+While a macro runs, the VM is checkpointed every `interval` commands (and
+after the last one). Each checkpoint is keyed by a hash chain over the start
+state and the commands sent so far, so a later run of the same or an edited
+macro from the same state resumes from the longest cached prefix and only
+executes the remaining commands. Checkpoints live in a size-bounded on-disk
+store which evicts the least recently used entries.
+
+Commands skipped this way don't repeat their side effects outside the VM
+(e.g. `.save` writing a snapshot file).
+'''
+import argparse
+import hashlib
+import os
+import pickle
+import re
+import time
+import zlib
+from pathlib import Path
+
+from basevm import CACHE_ROOT, memory_hash
+from vm import VM
+
+CHECKPOINT_DIR = CACHE_ROOT / 'macros'
+DEFAULT_INTERVAL = 10
+MAX_STORE_BYTES = 64 * 2**20
+CHECKPOINT_VERSION = 2  # checkpoints hold VM attributes, not the whole VM
+
+# per-session settings which are kept when restoring a checkpoint (including
+# watchpoints and the execute path they install)
+SESSION_ATTRS = ('live_output', 'tracing', 'watcher', 'execute')
+
+
+def session_attrs(vm: VM) -> tuple[str, ...]:
+    '''SESSION_ATTRS plus any declared by the VM's class (e.g. counters)'''
+
+    return SESSION_ATTRS + getattr(type(vm), 'SESSION_ATTRS', ())
+
+
+def state_key(vm: VM) -> str:
+    '''Hash of the VM state a macro starts from (ignoring unread output)'''
+
+    from bootcache import interpreter_version
+
+    state = {
+        k: v
+        for k, v in vars(vm).items()
+        if k not in ('memory', 'output', 'registers', *session_attrs(vm))
+    }
+    data = repr((
+        CHECKPOINT_VERSION,
+        interpreter_version(),
+        memory_hash(vm.memory),
+        list(vm.registers._regs),
+        sorted(state.items()),
+    ))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def prefix_keys(vm: VM, commands: list[str]) -> list[str]:
+    '''keys[i] identifies the state after sending the first i commands'''
+
+    keys = [state_key(vm)]
+    for cmd in commands:
+        keys.append(hashlib.sha256(f'{keys[-1]}\0{cmd}'.encode()).hexdigest())
+    return keys
+
+
+class CheckpointStore:
+    '''Compressed pickles of VM attributes (without session attributes) on
+    disk, bounded by total size (least recently used entries are evicted
+    first)'''
+
+    def __init__(self, directory=CHECKPOINT_DIR, max_bytes=MAX_STORE_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def path(self, key: str) -> Path:
+        return self.directory / f'{key[:32]}.ckpt'
+
+    def __contains__(self, key: str):
+        return self.path(key).exists()
+
+    def load(self, key: str, vm: VM) -> bool:
+        '''Restore the checkpoint into vm, returning whether it was found'''
+
+        path = self.path(key)
+        try:
+            state = pickle.loads(zlib.decompress(path.read_bytes()))
+        except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return False
+
+        vars(vm).update(state)
+        os.utime(path)  # mark as recently used
+        return True
+
+    def save(self, key: str, vm: VM):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        tmp = path.with_suffix(f'.tmp{os.getpid()}')
+        keep = session_attrs(vm)
+        state = {k: v for k, v in vars(vm).items() if k not in keep}
+        tmp.write_bytes(zlib.compress(pickle.dumps(state, protocol=5), 1))
+        tmp.replace(path)
+        self.prune()
+
+    def prune(self):
+        entries = sorted(
+            ((p.stat().st_mtime, p.stat().st_size, p)
+             for p in self.directory.glob('*.ckpt')),
+            reverse=True,
+        )
+        total = 0
+        for _, size, path in entries:
+            total += size
+            if total > self.max_bytes:
+                path.unlink(missing_ok=True)
+
+    def clear(self):
+        for path in self.directory.glob('*.ckpt'):
+            path.unlink()
+
+
+def read_macro(fname: str | Path) -> list[str]:
+    with open(fname) as f:
+        return re.split(r'[\n;]+', f.read().strip())
+
+
+def run_macro(
+    vm: VM,
+    commands: list[str],
+    interval=DEFAULT_INTERVAL,
+    store: CheckpointStore | None = None,
+    verbose=True,
+) -> int:
+    '''Send commands to the VM, resuming from the longest checkpointed
+    prefix. Returns the number of commands skipped.'''
+
+    store = store or CheckpointStore()
+    keys = prefix_keys(vm, commands)
+
+    start = next(
+        (i for i in range(len(commands), 0, -1)
+         if keys[i] in store and store.load(keys[i], vm)),
+        0,
+    )
+    if start and verbose:
+        print(
+            f'\033[93m>>> resumed from checkpoint after '
+            f'{start}/{len(commands)} commands\033[0m'
+        )
+
+    for i in range(start, len(commands)):
+        cmd = commands[i]
+        if verbose:
+            print(f'\033[93m>>> [{i}/{len(commands)}] sending "{cmd}"\033[0m')
+        vm.send(cmd)
+        if verbose:
+            print(vm.read())
+
+        done = i + 1
+        if done % interval == 0 or done == len(commands):
+            store.save(keys[done], vm)
+
+    return start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('macro', help='Path to a macro file')
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    parser.add_argument(
+        '-i',
+        '--interval',
+        type=int,
+        default=DEFAULT_INTERVAL,
+        help='Checkpoint every N commands',
+    )
+    parser.add_argument(
+        '-c',
+        '--clear',
+        action='store_true',
+        help='Delete all checkpoints before running',
+    )
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args()
+
+    from bootcache import boot_vm
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
+    vm.read()
+
+    store = CheckpointStore()
+    if args.clear:
+        store.clear()
+
+    commands = read_macro(args.macro)
+    start = time.perf_counter()
+    skipped = run_macro(vm, commands, args.interval, store, not args.quiet)
+    elapsed = time.perf_counter() - start
+    print(
+        f'\033[93mran {len(commands) - skipped}/{len(commands)} commands '
+        f'in {elapsed:.2f}s\033[0m'
+    )
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -1,9 +1,126 @@
+'''Map plotting for the explored location graphs.
+
+PNG layouts are cached on disk by graph hash, and each new map is seeded with
+the positions of previously plotted locations so only newly discovered
+locations need to be relaxed. Maps are rendered off-screen, and a PNG whose
+graph hasn't changed since it was last written is not rendered again.
+'''
+import hashlib
+import json
+import math
+import random
 import re
+from pathlib import Path
 
-import matplotlib.pyplot as plt
 import networkx as nx
+from matplotlib.figure import Figure
 from pyvis.network import Network
 
+from basevm import CACHE_ROOT
+
+LAYOUT_DIR = CACHE_ROOT / 'layouts'
+RENDERED = LAYOUT_DIR / 'rendered.json'
+
+LAYOUT_ITERATIONS = 500
+RELAX_ITERATIONS = 200
+MAX_NEW_FRACTION = 0.25  # of the nodes, above which all nodes are relaxed
+
+# positions of every location laid out so far, used to seed later maps
+_known_pos: dict[int, tuple[float, float]] = {}
+
+
+def graph_hash(edges, names) -> str:
+    data = json.dumps([
+        sorted((src, sorted(targets)) for src, targets in edges.items()),
+        sorted(names.items()),
+    ])
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+def incremental_layout(G, known: dict[int, tuple[float, float]]):
+    '''Spring layout seeded with the known node positions. Known nodes stay
+    fixed and only the new ones are relaxed, each starting next to its placed
+    neighbors.'''
+
+    seed = {n: known[n] for n in G if n in known}
+    if not seed:
+        return nx.spring_layout(G, seed=42, iterations=LAYOUT_ITERATIONS, k=1.5)
+
+    new = [n for n in G if n not in seed]
+    if not new:
+        return seed
+
+    # place new nodes in bfs order from the known ones, so most of them start
+    # next to an already placed neighbor
+    # fixed layouts aren't rescaled, so match the spacing of the known nodes
+    lengths = [
+        math.dist(seed[u], seed[v])
+        for u, v in G.edges() if u != v and u in seed and v in seed
+    ]
+    k = sum(lengths) / len(lengths) if lengths else 0.1
+
+    rng = random.Random(42)
+    pos = dict(seed)
+    order = list(nx.bfs_tree(G.to_undirected(), new[0]))
+    order += [n for n in new if n not in order]
+    xs, ys = zip(*seed.values())
+    for n in sorted(new, key=order.index):
+        placed = [pos[m] for m in nx.all_neighbors(G, n) if m in pos]
+        if placed:
+            x = sum(p[0] for p in placed) / len(placed)
+            y = sum(p[1] for p in placed) / len(placed)
+        else:
+            x, y = rng.uniform(min(xs), max(xs)), rng.uniform(min(ys), max(ys))
+        pos[n] = x + rng.uniform(-k, k), y + rng.uniform(-k, k)
+
+    # when much of the map is new, known nodes must move to make room, so run
+    # a full layout starting from the seeded positions instead
+    if len(new) > len(G) * MAX_NEW_FRACTION:
+        return nx.spring_layout(
+            G, pos=pos, seed=42, iterations=LAYOUT_ITERATIONS, k=1.5
+        )
+
+    return nx.spring_layout(
+        G,
+        pos=pos,
+        fixed=list(seed),
+        seed=42,
+        iterations=RELAX_ITERATIONS,
+        k=k,
+    )
+
+
+def cached_layout(G, key: str):
+    '''Return the layout for a graph, loading it from disk if the same graph
+    was laid out before'''
+
+    path = LAYOUT_DIR / f'{key}.json'
+    if path.exists():
+        pos = {n: (x, y) for n, x, y in json.loads(path.read_text())}
+    else:
+        pos = {
+            n: (float(x), float(y))
+            for n, (x, y) in incremental_layout(G, _known_pos).items()
+        }
+        LAYOUT_DIR.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps([[n, x, y] for n, (x, y) in pos.items()]))
+
+    _known_pos.update(pos)
+    return pos
+
+
+def is_rendered(fname, key: str):
+    if not Path(fname).exists() or not RENDERED.exists():
+        return False
+    return json.loads(RENDERED.read_text()).get(str(fname)) == key
+
+
+def mark_rendered(fname, key: str):
+    rendered = json.loads(RENDERED.read_text()) if RENDERED.exists() else {}
+    rendered[str(fname)] = key
+    LAYOUT_DIR.mkdir(parents=True, exist_ok=True)
+    RENDERED.write_text(json.dumps(rendered, indent=2))
+
 
 def plot_edges(edges, descs, fname=None, show=False):
     names = {}
@@ -11,8 +128,6 @@ def plot_edges(edges, descs, fname=None, show=False):
         m = re.search(r'== (.*?) ==', desc)
         names[loc] = m.group(1) if m else str(loc)
 
-    plt.figure(figsize=(8, 6))
-
     G = nx.MultiDiGraph()
 
     for loc in edges:
@@ -27,13 +142,26 @@ def plot_edges(edges, descs, fname=None, show=False):
         for dst, action in targets:
             G.add_edge(src, dst, label=action)
 
-    pos = nx.spring_layout(G, seed=42, iterations=500, k=1.5)
+    key = graph_hash(edges, names)
+    pos = cached_layout(G, key)
+
+    if fname and not show and is_rendered(fname, key):
+        return
+
+    # only use pyplot (and an interactive backend) when showing the plot
+    if show:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=(8, 6))
+    else:
+        fig = Figure(figsize=(8, 6))
+    ax = fig.add_subplot()
 
     node_colors = [G.nodes[n]['color'] for n in G.nodes]
 
     nx.draw(
         G,
         pos,
+        ax=ax,
         node_size=200,
         node_color=node_colors,
         edge_color='gray',
@@ -42,21 +170,22 @@ def plot_edges(edges, descs, fname=None, show=False):
     )
 
     node_labels = {n: names.get(n, str(n)) for n in G.nodes}
-    nx.draw_networkx_labels(G, pos, node_labels, font_size=8)
+    nx.draw_networkx_labels(G, pos, node_labels, font_size=8, ax=ax)
 
     edge_labels = nx.get_edge_attributes(G, 'label')
-    nx.draw_networkx_edge_labels(G, pos, edge_labels, font_size=7)
+    nx.draw_networkx_edge_labels(G, pos, edge_labels, font_size=7, ax=ax)
 
-    plt.title('Location Graph')
-    plt.axis('off')
-    plt.tight_layout()
+    ax.set_title('Location Graph')
+    ax.axis('off')
+    fig.tight_layout()
+
+    if fname:
+        fig.savefig(fname, dpi=300)
+        mark_rendered(fname, key)
 
     if show:
         plt.show()
 
-    if fname:
-        plt.savefig(fname, dpi=300)
-
 
 def node_style_from_name(name: str):
 
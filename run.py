@@ -1,19 +1,41 @@
 import argparse
 
-from vm import VM
+from bootcache import boot_vm
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--commands')
     parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    parser.add_argument(
+        '-r',
+        '--record',
+        action='store_true',
+        help='Record execution for .back, .back-to-write and .goto-step',
+    )
+    parser.add_argument(
+        '-i',
+        '--interval',
+        type=int,
+        default=10000,
+        help='Steps between recording checkpoints',
+    )
     args = parser.parse_args()
 
     print('Loading binary:', args.file)
 
-    vm = VM(args.file)
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
     print(vm.read())
 
+    if args.record:
+        from timetravel import RecordingVM
+        vm = RecordingVM.from_vm(vm, args.interval)
+
     if args.commands:
         for cmd in args.commands.split(';'):
             vm.send(cmd.strip())
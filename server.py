@@ -0,0 +1,210 @@
+'''Local multi-session game server.
+
+Protocol (one command per line, UTF-8):
+
+    <game command>       run a game command, e.g. "take tablet" or "n;e"
+    !snapshot [name]     save the session state under name (default "last")
+    !restore [name]      restore a previously saved session state
+    !stats               print command latency stats for this session
+    !quit                close the session
+
+Every response is a line holding the length in bytes of the UTF-8 encoded
+output, followed by exactly that many bytes of output (so no game output can be
+mistaken for the end of a response). New sessions receive the post-boot output
+as their first response.
+'''
+import argparse
+import asyncio
+import itertools
+import time
+
+from asyncvm import DEFAULT_SLICE, AsyncVM, percentile
+from bootcache import boot_vm
+from vm import VM, VMSnapshot
+
+
+class ClonePool:
+    '''Keeps a number of pre-booted VM clones ready to hand out'''
+
+    def __init__(self, vm: VM, size: int = 8):
+        self.base = vm.snapshot()
+        self.size = size
+        self.ready: list[VM] = [VM.from_snapshot(self.base) for _ in range(size)]
+        self._refilling = False
+
+    def acquire(self) -> VM:
+        vm = self.ready.pop() if self.ready else VM.from_snapshot(self.base)
+        if not self._refilling:
+            self._refilling = True
+            asyncio.get_running_loop().call_soon(self._refill)
+        return vm
+
+    def _refill(self):
+        # refill one clone per loop iteration so connections aren't starved
+        if len(self.ready) < self.size:
+            self.ready.append(VM.from_snapshot(self.base))
+            asyncio.get_running_loop().call_soon(self._refill)
+        else:
+            self._refilling = False
+
+
+class Session:
+
+    def __init__(self, sid: int, vm: VM, slice_size: int):
+        self.sid = sid
+        self.avm = AsyncVM(vm, slice_size, name=f'session-{sid}')
+        self.snapshots: dict[str, VMSnapshot] = {}
+        self.last_active = time.monotonic()
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def handle(self, line: str) -> str | None:
+        '''Execute one protocol line, returning its output (None to close)'''
+
+        self.last_active = time.monotonic()
+        vm = self.avm.vm
+
+        match line.split(maxsplit=1):
+            case ['!quit']:
+                return None
+            case ['!snapshot', *name]:
+                name = name[0] if name else 'last'
+                self.snapshots[name] = vm.snapshot()
+                return f'saved snapshot {name}\n'
+            case ['!restore', *name]:
+                name = name[0] if name else 'last'
+                if name not in self.snapshots:
+                    return f'error: no snapshot named {name}\n'
+                vm.apply_snapshot(self.snapshots[name])
+                self.avm.reopen()
+                return f'restored snapshot {name}\n'
+            case ['!stats']:
+                return self.avm.stats.summary() + '\n'
+            case [cmd, *_] if cmd.startswith(('!', '.')):
+                return f'error: unknown command {cmd}\n'
+
+        if self.avm.halted:
+            return 'error: session has halted\n'
+
+        await self.avm.send(line)
+        return self.avm.read()
+
+
+class GameServer:
+
+    def __init__(
+        self,
+        pool: ClonePool,
+        idle_timeout: float = 60,
+        slice_size: int = DEFAULT_SLICE,
+    ):
+        self.pool = pool
+        self.idle_timeout = idle_timeout
+        self.slice_size = slice_size
+        self.sessions: dict[int, Session] = {}
+        self.latencies: list[float] = []
+        self.sessions_opened = 0
+        self._ids = itertools.count()
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        session = Session(next(self._ids), self.pool.acquire(), self.slice_size)
+        session.writer = writer
+        self.sessions[session.sid] = session
+        self.sessions_opened += 1
+
+        try:
+            await self._respond(writer, session.avm.vm.read())
+            while line := await reader.readline():
+                start = time.perf_counter()
+                output = await session.handle(line.decode().strip())
+                if output is None:
+                    break
+                await self._respond(writer, output)
+                self.latencies.append(time.perf_counter() - start)
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.pop(session.sid, None)
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, output: str):
+        if output and not output.endswith('\n'):
+            output += '\n'
+        data = output.encode()
+        writer.write(f'{len(data)}\n'.encode() + data)
+        await writer.drain()
+
+    async def evict_idle(self, interval: float = 1):
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                if now - session.last_active > self.idle_timeout:
+                    print(f'evicting idle session {session.sid}')
+                    self.sessions.pop(session.sid, None)
+                    if session.writer:
+                        session.writer.close()
+
+    def report(self):
+        print(
+            f'{self.sessions_opened} sessions, {len(self.latencies)} cmds, '
+            f'p50 {percentile(self.latencies, 50) * 1000:.2f}ms, '
+            f'p99 {percentile(self.latencies, 99) * 1000:.2f}ms'
+        )
+
+
+async def start_server(
+    vm: VM,
+    host: str = '127.0.0.1',
+    port: int = 0,
+    pool_size: int = 8,
+    idle_timeout: float = 60,
+    slice_size: int = DEFAULT_SLICE,
+):
+    '''Start a game server for the given booted VM, returning (server, game)'''
+
+    game = GameServer(ClonePool(vm, pool_size), idle_timeout, slice_size)
+    server = await asyncio.start_server(game.handle_client, host, port)
+    asyncio.create_task(game.evict_idle())
+    return server, game
+
+
+async def serve(args):
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
+    server, game = await start_server(
+        vm, args.host, args.port, args.pool_size, args.idle_timeout,
+        args.slice
+    )
+    host, port = server.sockets[0].getsockname()[:2]
+    print(f'Serving on {host}:{port}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        game.report()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    parser.add_argument('-n', '--pool-size', type=int, default=8)
+    parser.add_argument('-i', '--idle-timeout', type=float, default=60)
+    parser.add_argument('-s', '--slice', type=int, default=DEFAULT_SLICE)
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    args = parser.parse_args()
+
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,313 @@
+'''Content-addressed snapshot repository for the `snapshots/` directory.
+
+Each saved snapshot is split into 256-word memory pages which are hashed and
+stored once across all saves: distinct pages are compressed (zlib or lzma) and
+appended to a pack file, and a small JSON index maps each page hash to its
+offset in the pack and each snapshot name to its list of page ids plus the
+rest of the VM state. Listing only reads the index, and diffing two snapshots
+only decodes the pages whose hashes differ.
+
+Snapshots saved by older versions as standalone repr files in `snapshots/`
+are still loadable by name, and can be imported with `--import`.
+'''
+import argparse
+import hashlib
+import json
+import lzma
+import os
+import zlib
+from array import array
+from itertools import zip_longest
+from pathlib import Path
+
+from vm import SNAPSHOTS_DIR, VM, VMSnapshot, diff_snapshots
+
+REPO_DIR = SNAPSHOTS_DIR / '.repo'
+PAGE_SIZE = 256
+INDEX_VERSION = 1
+
+# first byte of each stored page identifies how it was compressed
+CODECS = {
+    'zlib': (b'Z', lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (b'X', lzma.compress, lzma.decompress),
+}
+DECOMPRESS = {tag: decompress for tag, _, decompress in CODECS.values()}
+
+
+def page_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class SnapshotRepo:
+
+    def __init__(self, directory=REPO_DIR, codec='zlib'):
+        assert codec in CODECS, f'Unknown codec {codec!r}'
+        self.directory = Path(directory)
+        self.codec = codec
+        self.pages: list[tuple[str, int, int]] = []  # (hash, offset, length)
+        self.page_ids: dict[str, int] = {}
+        self.snapshots: dict[str, dict] = {}
+        self.decoded: dict[int, list[int]] = {}
+        self.read_index()
+
+    @property
+    def index_path(self):
+        return self.directory / 'index.json'
+
+    @property
+    def pack_path(self):
+        return self.directory / 'pages.pack'
+
+    @property
+    def legacy_dir(self):
+        return self.directory.parent
+
+    def read_index(self):
+        if not self.index_path.exists():
+            return
+        index = json.loads(self.index_path.read_text())
+        assert index['version'] == INDEX_VERSION, (
+            f'Unsupported snapshot index version {index["version"]}'
+        )
+        self.pages = [tuple(p) for p in index['pages']]
+        self.page_ids = {h: i for i, (h, _, _) in enumerate(self.pages)}
+        self.snapshots = index['snapshots']
+
+    def write_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix(f'.tmp{os.getpid()}')
+        tmp.write_text(
+            json.dumps({
+                'version': INDEX_VERSION,
+                'pages': self.pages,
+                'snapshots': self.snapshots,
+            })
+        )
+        tmp.replace(self.index_path)
+
+    # =====
+    # Pages
+    # =====
+
+    def add_pages(self, memory: list[int]) -> tuple[list[int], int]:
+        '''Store the pages of memory, returning their ids and how many were
+        new'''
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tag, compress, _ = CODECS[self.codec]
+        ids = []
+        new = 0
+        with open(self.pack_path, 'ab') as pack:
+            offset = pack.tell()
+            for start in range(0, len(memory), PAGE_SIZE):
+                data = array('H', memory[start:start + PAGE_SIZE]).tobytes()
+                h = page_hash(data)
+                if h not in self.page_ids:
+                    blob = tag + compress(data)
+                    pack.write(blob)
+                    self.page_ids[h] = len(self.pages)
+                    self.pages.append((h, offset, len(blob)))
+                    offset += len(blob)
+                    new += 1
+                ids.append(self.page_ids[h])
+        return ids, new
+
+    def read_page(self, page_id: int) -> list[int]:
+        if page_id not in self.decoded:
+            _, offset, length = self.pages[page_id]
+            with open(self.pack_path, 'rb') as pack:
+                pack.seek(offset)
+                blob = pack.read(length)
+            data = DECOMPRESS[blob[:1]](blob[1:])
+            self.decoded[page_id] = array('H', data).tolist()
+        return self.decoded[page_id]
+
+    # =========
+    # Snapshots
+    # =========
+
+    def save(self, name: str, snapshot: VMSnapshot) -> int:
+        '''Save a snapshot under name, returning how many new pages it
+        added'''
+
+        state = dict(snapshot)
+        ids, new = self.add_pages(state.pop('memory'))
+        self.snapshots[name] = {
+            'pages': ids,
+            'raw_size': len(repr(snapshot)),
+            'state': state,
+        }
+        self.write_index()
+        return new
+
+    def __contains__(self, name: str):
+        return name in self.snapshots or (self.legacy_dir / name).is_file()
+
+    def load(self, name: str) -> VMSnapshot:
+        if name not in self.snapshots:
+            path = self.legacy_dir / name
+            assert path.is_file(), f'No snapshot named {name!r}'
+            return VM.snapshot_from_file(path)
+
+        entry = self.snapshots[name]
+        memory = [w for i in entry['pages'] for w in self.read_page(i)]
+        return entry['state'] | {'memory': memory}
+
+    def delete(self, name: str):
+        assert name in self.snapshots, f'No snapshot named {name!r}'
+        del self.snapshots[name]
+        self.write_index()
+
+    def names(self) -> list[str]:
+        legacy = [
+            p.name for p in self.legacy_dir.glob('*')
+            if p.is_file() and p.name not in self.snapshots
+        ] if self.legacy_dir.exists() else []
+        return sorted([*self.snapshots, *legacy])
+
+    def view(self, snapshot: str | VMSnapshot):
+        '''(page hashes, page reader, state without memory) of a saved
+        snapshot, or of a legacy or live one'''
+
+        if isinstance(snapshot, str) and snapshot in self.snapshots:
+            entry = self.snapshots[snapshot]
+            ids = entry['pages']
+            hashes = [self.pages[i][0] for i in ids]
+            return hashes, lambda i: self.read_page(ids[i]), entry['state']
+
+        if isinstance(snapshot, str):
+            snapshot = self.load(snapshot)
+        memory = snapshot['memory']
+        hashes = [
+            page_hash(array('H', memory[s:s + PAGE_SIZE]).tobytes())
+            for s in range(0, len(memory), PAGE_SIZE)
+        ]
+        state = {k: v for k, v in snapshot.items() if k != 'memory'}
+        page = lambda i: memory[i * PAGE_SIZE:(i + 1) * PAGE_SIZE]
+        return hashes, page, state
+
+    def diff(self, snap1: str | VMSnapshot, snap2: str | VMSnapshot):
+        '''Diff two snapshots (by name, or live) in the format of
+        diff_snapshots, only decoding pages whose hashes differ'''
+
+        hashes1, page1, state1 = self.view(snap1)
+        hashes2, page2, state2 = self.view(snap2)
+        result = diff_snapshots(state1, state2)
+
+        changes = []
+        for i in range(max(len(hashes1), len(hashes2))):
+            if i < len(hashes1) and i < len(hashes2) and (
+                hashes1[i] == hashes2[i]
+            ):
+                continue
+            words1 = page1(i) if i < len(hashes1) else []
+            words2 = page2(i) if i < len(hashes2) else []
+            changes += [
+                (i * PAGE_SIZE + j, w1, w2)
+                for j, (w1, w2) in enumerate(zip_longest(words1, words2))
+                if w1 != w2
+            ]
+        if changes:
+            result['memory'] = changes
+        return result
+
+    # ===========
+    # Maintenance
+    # ===========
+
+    def import_legacy(self) -> list[str]:
+        '''Import standalone repr snapshots, removing the originals'''
+
+        imported = []
+        for path in sorted(self.legacy_dir.glob('*')):
+            if path.is_file() and path.name not in self.snapshots:
+                self.save(path.name, VM.snapshot_from_file(path))
+                path.unlink()
+                imported.append(path.name)
+        return imported
+
+    def gc(self) -> int:
+        '''Rewrite the pack without pages no snapshot refers to, returning
+        how many were dropped'''
+
+        used = sorted({i for e in self.snapshots.values() for i in e['pages']})
+        remap = {}
+        pages = []
+        tmp = self.pack_path.with_suffix(f'.tmp{os.getpid()}')
+        with open(tmp, 'wb') as pack:
+            for old in used:
+                h, _, length = self.pages[old]
+                with open(self.pack_path, 'rb') as src:
+                    src.seek(self.pages[old][1])
+                    blob = src.read(length)
+                remap[old] = len(pages)
+                pages.append((h, pack.tell(), length))
+                pack.write(blob)
+
+        dropped = len(self.pages) - len(pages)
+        for entry in self.snapshots.values():
+            entry['pages'] = [remap[i] for i in entry['pages']]
+        self.pages = pages
+        self.page_ids = {h: i for i, (h, _, _) in enumerate(pages)}
+        self.decoded.clear()
+        tmp.replace(self.pack_path)
+        self.write_index()
+        return dropped
+
+    def disk_usage(self) -> int:
+        return sum(
+            p.stat().st_size for p in (self.index_path, self.pack_path)
+            if p.exists()
+        )
+
+    def stats(self) -> str:
+        raw = sum(e['raw_size'] for e in self.snapshots.values())
+        return (
+            f'{len(self.snapshots)} snapshots, {len(self.pages)} distinct '
+            f'pages, {self.disk_usage() / 1024:.1f} KiB on disk '
+            f'({raw / 1024:.1f} KiB as standalone files)'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--dir', default=REPO_DIR, type=Path)
+    parser.add_argument(
+        '--import',
+        dest='import_legacy',
+        action='store_true',
+        help='Import standalone snapshot files into the repository',
+    )
+    parser.add_argument(
+        '--gc',
+        action='store_true',
+        help='Drop pages which are no longer used by any snapshot',
+    )
+    parser.add_argument('--delete', nargs='+', default=[], metavar='NAME')
+    args = parser.parse_args()
+
+    repo = SnapshotRepo(args.dir)
+    if args.import_legacy:
+        for name in repo.import_legacy():
+            print('imported', name)
+    for name in args.delete:
+        repo.delete(name)
+        print('deleted', name)
+    if args.gc:
+        print(f'dropped {repo.gc()} unused pages')
+
+    for name in repo.names():
+        if entry := repo.snapshots.get(name):
+            state = entry['state']
+            loc = state['location_addr']
+            print(f'{name:<24} pc {state["pc"]:>5}  location addr {loc}')
+        else:
+            print(f'{name:<24} (standalone file)')
+    print(f'\033[93m{repo.stats()}\033[0m')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
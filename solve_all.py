@@ -1,30 +1,43 @@
 import argparse
 import hashlib
 import re
+import sys
+from functools import partial
 from pathlib import Path
-from typing import Any, Callable
+from typing import TYPE_CHECKING, Any, Callable, Iterable
 
-from plot_maps import plot_edges, plot_edges_interactive
+from basevm import verify_opcodes
+from bootcache import boot_vm
 from vm import VM, diff_vms
 
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from statestore import StateStore
+
 
 def solve_all(
     arch_spec_fname,
     challenge_bin_fname,
     plot: Callable[[dict[int, Any], dict[int, Any], str], None],
+    use_cache=True,
 ):
+    from solve_coins import solve_vm as solve_coins_vm
+    from solve_vault import solve_vm as solve_vault_vm
+    from statestore import StateStore
+
     print(f'\033[93mLoading arch-spec: {arch_spec_fname}\033[0m')
     with open(arch_spec_fname) as f:
         data = f.read()
 
     m1 = re.search("Here's a code for the challenge website: (.*?)\n", data)
     assert m1, 'Missing arch-spec code'
+    verify_opcodes(arch_spec_fname)
     yield print_code(1, m1.group(1))
 
     print(f'\033[93mLoading binary: {challenge_bin_fname}\033[0m')
 
-    vm = VM(challenge_bin_fname)
-    vm.run()
+    vm = boot_vm(challenge_bin_fname, use_cache)
     data = vm.read()
 
     m2 = re.search('this one into the challenge website: (.*?)\n', data)
@@ -35,7 +48,7 @@ def solve_all(
     assert m3, 'Missing post-test code'
     yield print_code(3, m3.group(1))
 
-    edges, vm, descs, known_locs = find_and_collect_all(vm, {})
+    edges, vm, descs, known_locs = find_and_collect_all(vm, StateStore())
     plot(edges, descs, 'map0')
 
     vm.send('use can')
@@ -63,19 +76,18 @@ def solve_all(
     assert code5, 'Missing maze code'
     yield print_code(5, code5)
 
-    # Go to central hall
-    vm.location = next(
-        loc for loc, desc in descs.items() if
-        'There is a strange monument in the center of the hall with circular slots and unusual'
-        in desc
+    # Walk to central hall
+    vm.goto(
+        next(
+            loc for loc, desc in descs.items() if
+            'There is a strange monument in the center of the hall with circular slots and unusual'
+            in desc
+        )
     )
 
     print('\033[93m>> Solving coins puzzle\033[0m')
-    vm.send('use blue coin')
-    vm.send('use red coin')
-    vm.send('use shiny coin')
-    vm.send('use concave coin')
-    vm.send('use corroded coin')
+    for cmd in solve_coins_vm(vm):
+        vm.send(cmd)
 
     edges, vm, descs, known_locs = find_and_collect_all(vm, known_locs)
     plot(edges, descs, 'map2')
@@ -92,8 +104,7 @@ def solve_all(
     plot(edges, descs, 'map3')
 
     print('\033[93m>> Using teleporter again\033[0m')
-    vm.patch_teleporter_call()
-    vm.registers[7] = 25734
+    vm.registers[7] = vm.patch_teleporter_call()
     vm.send('use teleporter')
 
     m = re.search(
@@ -107,13 +118,13 @@ def solve_all(
     plot(edges, descs, 'map4')
 
     print('\033[93m>> Solving antechamber\033[0m')
-    vm.location = next(
-        loc for loc, desc in descs.items() if '== Vault Antechamber ==' in desc
-    )
+    vm.goto('Vault Antechamber')
 
+    # read the grid from the vault rooms before picking up the orb
+    vault_path = solve_vault_vm(vm)
     vm.send('look')
     vm.send('take orb')
-    vm.send('n;e;e;n;w;s;e;e;w;n;n;e')
+    vm.send(vault_path)
     vm.send('vault')
     vm.send('take mirror')
     vm.read()
@@ -129,24 +140,31 @@ def solve_all(
     plot(edges, descs, 'map5')
 
 
-def find_and_collect_all(vm: VM, known_locs: dict[int, VM]):
+def find_and_collect_all(vm: VM, known_locs: 'StateStore'):
+    from worldgraph import world_graph
+
     edges, descs, vms, item_addrs = find_all_states(vm)
+    world_graph(vm.binary_hash).update(edges, descs)
     vm = give_items(vm, item_addrs)
     print_new_locs(known_locs, vms)
-    return edges, vm, descs, known_locs | vms
+    known_locs.update(vms)
+    vms.close()
+    return edges, vm, descs, known_locs
 
 
 def find_all_states(vm: VM):
     edges, descs, vms = explore(vm)
-    item_addrs = identify_item_addrs(list(vms.values()))
+    item_addrs = identify_item_addrs(vms.values())
     print(f'Found {len(vms)} states and {len(item_addrs)} items\n')
     return edges, descs, vms, item_addrs
 
 
 def explore(vm: VM):
+    from statestore import StateStore
+
     vm.flush().send('look')
 
-    vms: dict[int, VM] = {}
+    vms = StateStore(vm.memory)
     # map current vm location => [(north_room_id, 'north'), ...]
     edges: dict[int, list[tuple[int, str]]] = {}
     descriptions = {vm.location: vm.read().strip()}
@@ -200,11 +218,9 @@ def give_items(vm: VM, item_addrs: dict[str, int]):
     return vm
 
 
-def print_new_locs(known_locs: dict[int, VM], vms: dict[int, VM]):
-    for loc in set(vms) - set(known_locs):
-        v = vms[loc]
-        v.read()
-        d = v.sendcopy('look').read()
+def print_new_locs(known_locs: 'StateStore', vms: 'StateStore'):
+    for loc in [loc for loc in vms if loc not in known_locs]:
+        d = vms[loc].clone().flush().send('look').read()
         if m := re.search(r'== (.*?) ==', d):
             d = m.group(1)
         print(f'New location: {loc} ({d})')
@@ -215,7 +231,7 @@ def print_code(num: int, code: str):
     return code
 
 
-def identify_item_addrs(vms: list[VM]):
+def identify_item_addrs(vms: Iterable[VM]):
     '''Given a list of VMs, find the names and memory addresses of all visible items'''
     addrs = {}
     for vm in vms:
@@ -230,6 +246,58 @@ def identify_item_addrs(vms: list[VM]):
     return addrs
 
 
+def plot_map(fmt: str, mapdir: Path, edges, descs, name: str):
+    '''Render one map to mapdir/<name>.<fmt> (runs in a worker process)'''
+
+    # plotting dependencies are slow to import, so only load them if needed
+    from plot_maps import plot_edges, plot_edges_interactive
+
+    if fmt == 'png':
+        plot_edges(edges, descs, fname=str(mapdir / f'{name}.png'), show=False)
+    else:
+        plot_edges_interactive(edges, descs, fname=str(mapdir / f'{name}.html'))
+
+
+class BackgroundPlotter:
+    '''Renders maps in worker processes while the solver keeps running.
+
+    Each format gets its own single-worker pool, so its maps render in order
+    (PNG layouts are seeded from the previous map) while different formats
+    render in parallel.'''
+
+    def __init__(self, formats: list[str], mapdir: Path):
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.pools = {
+            fmt: ProcessPoolExecutor(max_workers=1)
+            for fmt in dict.fromkeys(formats)
+        }
+        self.mapdir = mapdir
+        self.futures: list[tuple[str, 'Future']] = []
+
+    def __call__(self, edges, descs, name: str):
+        for fmt, pool in self.pools.items():
+            render = partial(plot_map, fmt, self.mapdir)
+            future = pool.submit(render, edges, descs, name)
+            self.futures.append((f'{name}.{fmt}', future))
+
+    def wait(self) -> list[str]:
+        '''Wait for all maps to render, returning any errors'''
+
+        errors = []
+        for fname, future in self.futures:
+            try:
+                future.result()
+            except Exception as exc:
+                errors.append(f'{fname}: {exc!r}')
+        self.close()
+        return errors
+
+    def close(self, cancel=False):
+        for pool in self.pools.values():
+            pool.shutdown(cancel_futures=cancel)
+
+
 def reflect(s: str):
     d = {'d': 'b', 'p': 'q'}
     d |= {v: k for k, v in d.items()}
@@ -264,6 +332,13 @@ def main():
         '-p',
         '--map-format',
         choices=['png', 'html'],
+        action='append',
+        help='Render maps in the background (can be given more than once)',
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
     )
     args = parser.parse_args()
 
@@ -273,20 +348,20 @@ def main():
     mapdir = Path('maps')
     mapdir.mkdir(exist_ok=True)
 
-    plot_funcs = {
-        'png':
-        lambda edges, descs, name: plot_edges(
-            edges, descs, fname=str(mapdir / f'{name}.png'), show=False
-        ),
-        'html':
-        lambda edges, descs, name: plot_edges_interactive(
-            edges, descs, fname=str(mapdir / f'{name}.html')
-        ),
-    }
+    plot = lambda *args: None
+    plotter = None
 
-    plot = plot_funcs.get(args.map_format, lambda *args: None)
+    if args.map_format:
+        plotter = plot = BackgroundPlotter(args.map_format, mapdir)
 
-    codes = list(solve_all(archfile, binfile, plot))
+    try:
+        codes = list(solve_all(archfile, binfile, plot, not args.no_cache))
+    except BaseException:
+        if plotter:
+            plotter.close(cancel=True)
+        raise
+
+    plot_errors = plotter.wait() if plotter else []
 
     hashes = [
         '1da5f227bccdc25af7e599945a6c6916',
@@ -307,6 +382,11 @@ def main():
     if args.map_format is None:
         print('\033[95mNOTE: Skipped writing maps to HTML/PNG.\n\033[0m')
 
+    for error in plot_errors:
+        print(f'\033[91mFailed to plot {error}\033[0m')
+    if plot_errors:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     try:
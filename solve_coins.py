@@ -1,6 +1,17 @@
-from itertools import combinations, permutations
+'''Solves the monument equation in the ruins by placing coins in its slots.
 
-from z3 import Int, Or, Solver, sat
+The equation (`_ + _ * _^2 + _^3 - _ = 399`) and the value of each coin are
+read from the game, then solved by meet-in-the-middle: the terms are split into
+two halves, every placement of coins into the left half is indexed by its
+partial sum, and each placement into the right half looks up the remaining
+sum with a disjoint set of coins.
+'''
+import argparse
+import random
+import re
+import time
+from dataclasses import dataclass
+from itertools import combinations, permutations
 
 COIN_NAMES = {
     2: 'red coin',
@@ -10,14 +21,181 @@ COIN_NAMES = {
     9: 'blue coin',
 }
 
+EQUATION = '_ + _ * _^2 + _^3 - _ = 399'
+
+NUMBER_WORDS = {
+    w: n
+    for n, w in enumerate(
+        'zero one two three four five six seven eight nine ten'.split()
+    )
+}
+
+SHAPE_SIDES = {
+    'triangle': 3,
+    'square': 4,
+    'pentagon': 5,
+    'hexagon': 6,
+    'heptagon': 7,
+    'octagon': 8,
+    'nonagon': 9,
+    'decagon': 10,
+}
+
+TOKEN = re.compile(r'\s*(_|\d+|[-+*^=])')
+
+
+@dataclass
+class Factor:
+    slot: int | None  # index of the coin slot, or None for a constant
+    value: int = 1
+    power: int = 1
+
+
+@dataclass
+class Term:
+    sign: int
+    factors: list[Factor]
+
+    @property
+    def slots(self):
+        return [f.slot for f in self.factors if f.slot is not None]
+
+    def evaluate(self, coins: dict[int, int]) -> int:
+        result = self.sign
+        for f in self.factors:
+            result *= (f.value if f.slot is None else coins[f.slot])**f.power
+        return result
+
+
+@dataclass
+class Equation:
+    terms: list[Term]
+    target: int
+
+    @property
+    def nslots(self):
+        return sum(len(term.slots) for term in self.terms)
+
+    def evaluate(self, coins: list[int]) -> int:
+        slots = dict(enumerate(coins))
+        return sum(term.evaluate(slots) for term in self.terms)
+
+
+def parse_equation(text: str) -> Equation:
+    '''Parse an equation like `_ + _ * _^2 + _^3 - _ = 399`, where each `_`
+    is a coin slot (numbered left to right)'''
+
+    text = text.strip()
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = TOKEN.match(text, pos)
+        assert m, f'Unexpected character in equation: {text[pos:]!r}'
+        tokens.append(m.group(1))
+        pos = m.end()
+
+    assert tokens.count('=') == 1, f'Expected one "=" in {text!r}'
+    eq = tokens.index('=')
+    assert eq == len(tokens) - 2 and tokens[-1].isdigit(), (
+        f'Expected a constant right-hand side in {text!r}'
+    )
+
+    terms = [Term(1, [])]
+    nslots = 0
+    expect_factor = True
+    i = 0
+    while i < eq:
+        tok = tokens[i]
+        if expect_factor:
+            if tok == '_':
+                factor = Factor(nslots)
+                nslots += 1
+            else:
+                assert tok.isdigit(), f'Unexpected {tok!r} in {text!r}'
+                factor = Factor(None, int(tok))
+            if tokens[i + 1] == '^':
+                factor.power = int(tokens[i + 2])
+                i += 2
+            terms[-1].factors.append(factor)
+            expect_factor = False
+        elif tok in '+-':
+            terms.append(Term(1 if tok == '+' else -1, []))
+            expect_factor = True
+        else:
+            assert tok == '*', f'Unexpected {tok!r} in {text!r}'
+            expect_factor = True
+        i += 1
+
+    return Equation(terms, int(tokens[-1]))
+
+
+def parse_coin_value(desc: str) -> int:
+    '''Read a coin's value from its description ("It has seven dots on one
+    side", "It has a pentagon on one side")'''
+
+    m = re.search(r'It has (?:an? )?(.*?) on one side', desc)
+    assert m, f'Missing coin value: {desc!r}'
+    marks = m.group(1)
+    if m := re.fullmatch(r'(\w+) dots?', marks):
+        word = m.group(1)
+        return int(word) if word.isdigit() else NUMBER_WORDS[word]
+    return SHAPE_SIDES[marks]
+
+
+def placements(terms: list[Term], values: list[int]):
+    '''Yields (sum, coin mask, {slot: coin index}) for every way of placing
+    distinct coins into the slots of the given terms'''
+
+    slots = [s for term in terms for s in term.slots]
+    for chosen in permutations(range(len(values)), len(slots)):
+        assignment = dict(zip(slots, chosen))
+        coins = {s: values[c] for s, c in assignment.items()}
+        mask = 0
+        for c in chosen:
+            mask |= 1 << c
+        yield sum(t.evaluate(coins) for t in terms), mask, assignment
+
+
+def solve_equation(equation: Equation, values: list[int]) -> list[int] | None:
+    '''Solve by meet-in-the-middle, returning the index of the coin placed in
+    each slot (or None if there is no solution)'''
+
+    nslots = equation.nslots
+    assert nslots <= len(values), 'More slots than coins'
+
+    # split the terms so both halves have roughly half of the slots
+    split, seen = 0, 0
+    for split, term in enumerate(equation.terms):
+        if seen + len(term.slots) / 2 > nslots / 2:
+            break
+        seen += len(term.slots)
+    left, right = equation.terms[:split], equation.terms[split:]
+
+    index: dict[int, list[tuple[int, dict[int, int]]]] = {}
+    for total, mask, assignment in placements(left, values):
+        index.setdefault(total, []).append((mask, assignment))
+
+    for total, mask, assignment in placements(right, values):
+        for left_mask, left_assignment in index.get(
+            equation.target - total, []
+        ):
+            if not left_mask & mask:
+                coins = left_assignment | assignment
+                return [coins[s] for s in range(nslots)]
+    return None
+
 
 def solve_coin_order():
+    '''Brute-force the built-in equation with the built-in coins'''
+
     for a, b, c, d, e in permutations(COIN_NAMES):
         if a + b * c**2 + d**3 - e == 399:
             return [a, b, c, d, e]
 
 
 def solve_coin_order_z3():
+    from z3 import Int, Or, Solver, sat
+
     a, b, c, d, e = vals = [Int(chr(ord('a') + i)) for i in range(5)]
 
     s = Solver()
@@ -30,10 +208,107 @@ def solve_coin_order_z3():
     return [m[v].as_long() for v in vals]
 
 
-coins = solve_coin_order()
-# coins = solve_coin_order_z3()
+def read_puzzle(vm) -> tuple[Equation, dict[str, int]]:
+    '''Read the monument equation and the value of each coin in the inventory
+    from a VM standing at the monument'''
+
+    desc = vm.clone().flush().send('look').read()
+    m = re.search(r'It reads:\s*\n(.*?=.*?)\n', desc)
+    assert m, 'Missing monument equation'
+    equation = parse_equation(m.group(1))
+
+    inventory = vm.clone().flush().send('inv').read()
+    names = re.findall(r'- (.*? coin)\n', inventory)
+    coins = {
+        name: parse_coin_value(vm.clone().flush().send(f'look {name}').read())
+        for name in names
+    }
+    return equation, coins
+
+
+def solve_vm(vm) -> list[str]:
+    '''Solve the monument puzzle from a VM standing at the monument, returning
+    the commands which place the coins'''
+
+    equation, coins = read_puzzle(vm)
+    names = list(coins)
+    order = solve_equation(equation, list(coins.values()))
+    assert order, 'No coin order solves the monument equation'
+    return [f'use {names[i]}' for i in order]
+
+
+def random_equation(ncoins: int, seed: int | None = None):
+    '''Generate a random solvable equation over distinct coin values'''
+
+    rng = random.Random(seed)
+    values = rng.sample(range(1, 4 * ncoins), ncoins)
+    order = rng.sample(values, ncoins)
+
+    parts = []
+    for i in range(ncoins):
+        op = rng.choice('+-*') if i else ''
+        power = rng.choice(['', '', '^2', '^3'])
+        parts.append(f'{op} _{power}' if op else f'_{power}')
+    text = ' '.join(parts)
+    target = parse_equation(f'{text} = 0').evaluate(order)
+    if target < 0:
+        text = f'{-target} + {text}'
+        target = 0
+    return f'{text} = {target}', values
+
+
+def benchmark(sizes: list[int], seed: int = 0):
+    for n in sizes:
+        text, values = random_equation(n, seed)
+        equation = parse_equation(text)
+
+        start = time.perf_counter()
+        order = solve_equation(equation, values)
+        elapsed = time.perf_counter() - start
+
+        assert order is not None
+        assert equation.evaluate([values[i] for i in order]) == equation.target
+        print(f'\033[93m{n} coins: {elapsed * 1000:.1f}ms\033[0m  {text}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--equation', default=EQUATION)
+    parser.add_argument(
+        '-z',
+        '--z3',
+        action='store_true',
+        help='Solve the built-in equation with z3',
+    )
+    parser.add_argument(
+        '--benchmark',
+        type=int,
+        nargs='*',
+        metavar='NCOINS',
+        help='Time the solver on random equations with this many coins',
+    )
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark(args.benchmark or [5, 6, 7, 8, 9, 10])
+        return
+
+    if args.z3:
+        coins = solve_coin_order_z3()
+    else:
+        values = list(COIN_NAMES)
+        order = solve_equation(parse_equation(args.equation), values)
+        assert order, 'No solution found'
+        coins = [values[i] for i in order]
+
+    print('coin order:', coins, '\n')
+
+    for coin in coins:
+        print('use', COIN_NAMES[coin])
 
-print('coin order:', coins, '\n')
 
-for coin in coins:
-    print('use', COIN_NAMES[coin])
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
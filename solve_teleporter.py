@@ -1,6 +1,7 @@
 import argparse
+import random
 import time
-from multiprocessing import Event, Pool
+from multiprocessing import Event, Pool, TimeoutError, Value
 
 
 # reference implementation of call 6027 which resembles the Ackermann function
@@ -31,11 +32,26 @@ def f(r0, r1, r7):
 # thus we will be looking for f3[f3[C]] == 6
 
 solution_found = Event()
+progress = None  # shared count of checked r7 values (set in pool workers)
+
+BATCH_SIZE = 8
+MAX_FAST_R0 = 4  # f(5, B) and beyond have no closed form (or feasible value)
+
+
+def init_worker(event, counter):
+    '''Share the cancellation event and progress counter with a pool worker'''
+
+    global solution_found, progress
+    solution_found = event
+    progress = counter
 
 
 def worker(start, end, exit_early=True):
     solution = None
     for r7 in range(start, end):
+        if exit_early and solution_found.is_set():
+            break
+
         f3 = [0] * 32768
         f3[0] = (
             r7 * (r7 + 1) + 2 * r7 + 1
@@ -48,35 +64,223 @@ def worker(start, end, exit_early=True):
             solution_found.set()
             solution = r7
 
-        if exit_early and solution_found.is_set():
-            break
+        if progress is not None:
+            with progress.get_lock():
+                progress.value += 1
 
     return solution
 
 
-def worker_callback(result):
-    if result is not None:
-        print(f'Solution: r7 = {result}')
+def worker_batch(args):
+    return worker(*args)
+
+
+def make_batches(r7s: range, processes: int, batch_size: int):
+    '''Split the range into small batches, interleaved so that every
+    1/processes region of the range is searched in parallel (as with one
+    static chunk per process) while idle workers can still pick up any
+    remaining batch'''
+
+    region = -(-len(r7s) // processes)
+    regions = [
+        range(lo, min(lo + region, r7s.stop))
+        for lo in range(r7s.start, r7s.stop, region)
+    ]
+    batches = []
+    for offset in range(0, region, batch_size):
+        for r in regions:
+            lo = r.start + offset
+            if lo < r.stop:
+                batches.append((lo, min(lo + batch_size, r.stop)))
+    return batches
+
+
+def main_multi(
+    processes: int,
+    exit_early: bool,
+    batch_size: int = BATCH_SIZE,
+    r7s: range = range(32768),
+):
+    '''Multi-processing method where workers pull small batches of r7 values
+    from the pool's shared task queue'''
+
+    event = Event()
+    counter = Value('i', 0)
+    batches = [
+        (lo, hi, exit_early)
+        for lo, hi in make_batches(r7s, processes, batch_size)
+    ]
+    solutions = []
+
+    print(f'Spawning {processes} processes for {len(batches)} batches...')
+
+    start = last_time = time.time()
+    last_val = 0
+    with Pool(
+        processes, initializer=init_worker, initargs=(event, counter)
+    ) as pool:
+        results = pool.imap_unordered(worker_batch, batches)
+        remaining = len(batches)
+        while remaining:
+            try:
+                result = results.next(timeout=1)
+                remaining -= 1
+            except TimeoutError:
+                result = None
+
+            if result is not None:
+                print(f'Solution: r7 = {result}')
+                solutions.append(result)
+                if exit_early:
+                    pool.terminate()
+                    break
+
+            # print aggregate progress every second
+            diff = time.time() - last_time
+            if diff > 1:
+                checked = counter.value
+                speed = (checked - last_val) / diff
+                eta = (len(r7s) - checked) / speed / 60 if speed else 0
+                print(
+                    'checked {}, {:.2f} it/sec, {:.2f} min left'.format(
+                        checked, speed, eta
+                    )
+                )
+                last_val = checked
+                last_time = time.time()
 
+    elapsed = time.time() - start
+    print(
+        f'Checked {counter.value} values in {elapsed:.2f}s '
+        f'({counter.value / elapsed:.2f} it/sec)'
+    )
+    return solutions
 
-def main_multi(processes: int, exit_early: bool):
-    '''Multi-processing method which takes ~18s on my hardware'''
 
-    chunksize = 32768 // processes
-    results = []
+def affine_pow(a: int, b: int, n: int, mod=32768):
+    '''Return (A, B) such that applying x -> a*x + b n times gives A*x + B'''
 
-    print(f'Spawning {processes} processes...')
+    result_a, result_b = 1, 0
+    while n:
+        if n & 1:
+            result_a, result_b = a * result_a % mod, (a * result_b + b) % mod
+        a, b = a * a % mod, (a * b + b) % mod
+        n >>= 1
+    return result_a, result_b
 
-    with Pool(processes, initargs=(solution_found, )) as pool:
-        for start in range(0, 32768, chunksize):
-            args = (start, min(start + chunksize + 1, 32768), exit_early)
-            result = pool.apply_async(
-                worker, args=args, callback=worker_callback
-            )
-            results.append(result)
 
-        for result in results:
-            result.get()
+def f3_closed(r7: int, n: int):
+    '''Evaluate f3[n] = f(3, n) in O(log n) using affine-map doubling.
+
+    f3[i] = f3[i-1] * (r7+1) + 2*r7 + 1 is an affine map applied n times to
+    f3[0] = f(2, r7), so we can raise the map to the nth power by squaring.'''
+
+    f3_0 = (r7 * (r7 + 1) + 2 * r7 + 1) % 32768
+    a, b = affine_pow(r7 + 1, 2 * r7 + 1, n)
+    return (a * f3_0 + b) % 32768
+
+
+def solve_closed_form():
+    '''Return every r7 where f(4, 1) = f3[f3[r7]] == 6'''
+
+    return [r7 for r7 in range(32768) if f3_closed(r7, f3_closed(r7, r7)) == 6]
+
+
+def f_fast(r0: int, r1: int, r7: int):
+    '''Evaluate f(r0, r1) for r0 <= MAX_FAST_R0 without recursion'''
+
+    match r0:
+        case 0:
+            return (r1 + 1) % 32768
+        case 1:
+            return (r1 + r7 + 1) % 32768
+        case 2:
+            return (r1 * (r7 + 1) + 2 * r7 + 1) % 32768
+        case 3:
+            return f3_closed(r7, r1)
+        case 4:
+            # f(4, 0) = f(3, r7) and f(4, B) = f(3, f(4, B-1))
+            val = f3_closed(r7, r7)
+            for _ in range(r1):
+                val = f3_closed(r7, val)
+            return val
+    raise ValueError(
+        f'f({r0}, {r1}) can only be evaluated for r0 <= {MAX_FAST_R0}'
+    )
+
+
+def solve_r7(r0: int, r1: int, expected: int):
+    '''Return every nonzero r7 for which f(r0, r1) == expected'''
+
+    return [r7 for r7 in range(1, 32768) if f_fast(r0, r1, r7) == expected]
+
+
+def main_closed_form(verify: int):
+    '''Analytic method which checks every r7 in O(log n) each'''
+
+    start = time.time()
+    solutions = solve_closed_form()
+    elapsed = time.time() - start
+
+    for r7 in solutions:
+        print(f'Solution: r7 = {r7}')
+    print(f'Checked 32768 values in {elapsed:.2f}s')
+
+    # cross-check against the table-based worker
+    samples = set(solutions) | set(random.sample(range(32768), verify))
+    for r7 in sorted(samples):
+        expected = r7 if r7 in solutions else None
+        assert worker(r7, r7 + 1, exit_early=False) == expected, (
+            f'Closed form disagrees with table for r7 = {r7}'
+        )
+    print(f'Verified {len(samples)} values against the table-based worker')
+
+
+def f3_numpy(r7s, targets):
+    '''Advance the f3 recurrence for a vector of r7 values at once, returning
+    f3[target] for each lane'''
+
+    import numpy as np
+
+    r7s = r7s.astype(np.uint32)
+    targets = targets.astype(np.uint32)
+    mul = r7s + 1
+    inc = 2 * r7s + 1
+    x = (r7s * (r7s + 1) + 2 * r7s + 1) & 0x7fff  # f3[0] = f(2, r7)
+
+    # lanes grouped by the step at which their value should be captured
+    order = np.argsort(targets, kind='stable')
+    bounds = np.searchsorted(targets[order], np.arange(32769))
+
+    result = np.zeros_like(x)
+    for i in range(int(targets.max()) + 1):
+        if bounds[i] != bounds[i + 1]:
+            lanes = order[bounds[i]:bounds[i + 1]]
+            result[lanes] = x[lanes]
+        x = (x * mul + inc) & 0x7fff
+    return result
+
+
+def main_numpy(chunksize: int):
+    '''Vectorized method which advances all r7 values in lockstep'''
+
+    try:
+        import numpy as np
+    except ImportError:
+        raise SystemExit('--numpy requires numpy (pip install numpy)')
+
+    start = time.time()
+    solutions = []
+    for lo in range(0, 32768, chunksize):
+        r7s = np.arange(lo, min(lo + chunksize, 32768), dtype=np.uint32)
+        f3_r7 = f3_numpy(r7s, r7s)
+        f4_1 = f3_numpy(r7s, f3_r7)
+        solutions += [int(r7) for r7 in r7s[f4_1 == 6]]
+
+    elapsed = time.time() - start
+    for r7 in solutions:
+        print(f'Solution: r7 = {r7}')
+    print(f'numpy: {32768 / elapsed:.2f} it/sec, {elapsed:.2f}s total')
 
 
 def main_single():
@@ -116,16 +320,43 @@ def main():
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-s', '--single', action='store_true')
     group.add_argument('-m', '--multi', action='store_true')
+    group.add_argument('-c', '--closed-form', action='store_true')
+    group.add_argument('-n', '--numpy', action='store_true')
+    parser.add_argument(
+        '--chunk',
+        type=int,
+        default=8192,
+        help='Number of r7 values per vector in numpy mode',
+    )
     parser.add_argument('-p', '--processes', type=int, default=8)
     parser.add_argument('-nx', '--dont-exit-early', action='store_true')
+    parser.add_argument(
+        '-b',
+        '--batch-size',
+        type=int,
+        default=BATCH_SIZE,
+        help='Number of r7 values handed to a worker at a time',
+    )
+    parser.add_argument(
+        '-v',
+        '--verify',
+        type=int,
+        default=16,
+        help='Number of random r7 values to cross-check in closed-form mode',
+    )
     args = parser.parse_args()
 
-    if args.single:
+    if args.closed_form:
+        main_closed_form(args.verify)
+    elif args.numpy:
+        main_numpy(args.chunk)
+    elif args.single:
         main_single()
     else:
         main_multi(
             processes=args.processes,
             exit_early=not args.dont_exit_early,
+            batch_size=args.batch_size,
         )
 
 
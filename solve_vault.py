@@ -1,6 +1,16 @@
+import argparse
+import heapq
+import json
+import random
+import re
 import sys
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from itertools import pairwise
+from itertools import count, pairwise
+
+from basevm import CACHE_ROOT, memory_hash
+from vm import VM
 
 GRID_LIST = [
     ['*', 8, '-', 1],
@@ -9,7 +19,9 @@ GRID_LIST = [
     [22, '-', 9, '*'],
 ]
 
-GRID = {
+Grid = dict[tuple[int, int], int | str]
+
+GRID: Grid = {
     (r, c): v
     for r, row in enumerate(GRID_LIST)
     for c, v in enumerate(row)
@@ -18,6 +30,19 @@ GRID = {
 DIRS = [(-1, 0), (1, 0), (0, 1), (0, -1)]
 DIR_TO_CMD = dict(zip(DIRS, 'nsew'))
 
+MAX_VALUE = 32767  # the orb's weight is stored in a single VM word
+
+VAULT_CACHE = CACHE_ROOT / 'vault.json'
+VAULT_TITLES = ('Vault Antechamber', 'Vault Lock', 'Vault Door')
+MOVES = {'north': (-1, 0), 'south': (1, 0), 'east': (0, 1), 'west': (0, -1)}
+ROOM_CACHE_SIZE = 4
+
+INVERSE_OPS = {
+    '+': lambda v, n: v - n,
+    '-': lambda v, n: v + n,
+    '*': lambda v, n: v // n if n and v % n == 0 else None,
+}
+
 
 @dataclass(frozen=True, order=True)
 class State:
@@ -26,8 +51,16 @@ class State:
     op: str | None = '+'
 
 
-def move(state: State, newpos: tuple[int, int]):
-    v = GRID[newpos]
+def grid_from_list(grid_list: list[list[int | str]]) -> Grid:
+    return {
+        (r, c): v
+        for r, row in enumerate(grid_list)
+        for c, v in enumerate(row)
+    }
+
+
+def move(state: State, newpos: tuple[int, int], grid: Grid = GRID):
+    v = grid[newpos]
 
     if not isinstance(v, int):
         return State(newpos, state.value, v)
@@ -42,35 +75,115 @@ def move(state: State, newpos: tuple[int, int]):
     return State(newpos, values[state.op], None)
 
 
-def neighbors(r, c):
-    return {(r + dr, c + dc) for dr, dc in DIRS if (r + dr, c + dc) in GRID}
+def neighbors(r, c, grid: Grid = GRID):
+    return {(r + dr, c + dc) for dr, dc in DIRS if (r + dr, c + dc) in grid}
+
+
+def next_states(state, grid: Grid = GRID):
+    return [
+        move(state, p, grid) for p in neighbors(*state.pos, grid)
+        if state.op or not isinstance(grid[p], int)
+    ]
+
+
+def distance(a: tuple[int, int], b: tuple[int, int]):
+    return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
 
+class Bounds:
+    '''Value-range pruning: drops states whose value can no longer reach the
+    goal value within the remaining step budget'''
 
-def next_states(state):
-    return [move(state, p) for p in neighbors(*state.pos)]
+    def __init__(self, grid: Grid, goal_val: int, max_steps: int | None):
+        numbers = [v for v in grid.values() if isinstance(v, int)]
+        self.max_num = max(numbers)
+        self.has_zero = 0 in numbers
+        self.goal_val = goal_val
+        self.max_steps = max_steps
+
+    def feasible(self, state: State, steps: int, goal_pos) -> bool:
+        if not 0 <= state.value <= MAX_VALUE:
+            return False
+        if self.max_steps is None:
+            return True
+
+        remaining = self.max_steps - steps
+        if remaining < distance(state.pos, goal_pos):
+            return False
+
+        # every operation needs an op room followed by a number room
+        ops = (remaining + 1) // 2 if state.op else remaining // 2
+        lo = 0 if self.has_zero else max(state.value - ops * self.max_num, 0)
+        hi = state.value
+        for _ in range(ops):
+            if hi >= self.goal_val:
+                break
+            hi = max(hi + self.max_num, hi * self.max_num)
+        return lo <= self.goal_val <= hi
 
 
 def solve(
     start_pos: tuple[int, int],
     goal_pos: tuple[int, int],
     goal_val: int,
-):
-    start_val = GRID[start_pos]
+    grid: Grid = GRID,
+    max_steps: int | None = None,
+    bidirectional=False,
+) -> list[str] | None:
+    '''Find the shortest list of moves (n/s/e/w) which carries the orb from the
+    start to the goal with the goal value, or None if there is none.
+
+    The start room may not be revisited, and the goal room may only be
+    entered with the correct value. States whose value goes negative, or can't
+    reach the goal value within max_steps, are pruned.'''
+
+    start_val = grid[start_pos]
     assert isinstance(start_val, int), f'Invalid starting value: {start_val}'
 
-    state = State(start_pos, start_val)
-    q = [state]
-    parent = {}
+    search = solve_bidirectional if bidirectional else solve_best_first
+    path, iterations = search(start_pos, goal_pos, goal_val, grid, max_steps)
+    if path is None:
+        print(f'no solution after {iterations} iterations', file=sys.stderr)
+        return None
+
+    # convert solution to NESW directions
+    directions = []
+    for p1, p2 in pairwise(path):
+        dr, dc = [a - b for a, b in zip(p2, p1)]
+        directions.append(DIR_TO_CMD[dr, dc])
+
+    print(
+        f'found {len(directions)} move solution after {iterations} iterations',
+        file=sys.stderr
+    )
+    return directions
+
+
+def solve_best_first(start_pos, goal_pos, goal_val, grid, max_steps):
+    '''A* over (pos, value, op) states, ordered by steps taken plus the
+    manhattan distance left to the goal'''
+
+    bounds = Bounds(grid, goal_val, max_steps)
+    state = State(start_pos, grid[start_pos])
+    tiebreak = count()
+    q = [(distance(start_pos, goal_pos), 0, next(tiebreak), state)]
+    parent = {state: None}
+    depth = {state: 0}
     iterations = 0
 
     while q:
         iterations += 1
-        state = q.pop(0)
+        _, steps, _, state = heapq.heappop(q)
+        if steps > depth[state]:
+            continue  # already reached by a shorter path
 
         if state.value == goal_val and state.pos == goal_pos:
-            break
+            path = [state.pos]
+            while state := parent[state]:
+                path.append(state.pos)
+            return path[::-1], iterations
 
-        for next_state in next_states(state):
+        for next_state in next_states(state, grid):
             # avoid revisiting starting position
             if next_state.pos == start_pos:
                 continue
@@ -79,37 +192,343 @@ def solve(
             if next_state.pos == goal_pos and next_state.value != goal_val:
                 continue
 
-            if next_state not in parent:
-                parent[next_state] = state
-                q.append(next_state)
+            if depth.get(next_state, steps + 2) <= steps + 1:
+                continue
+            if not bounds.feasible(next_state, steps + 1, goal_pos):
+                continue
 
-    # reconstruct solution
-    solution = [state]
-    while state := parent.get(state):
-        solution.append(state)
+            parent[next_state] = state
+            depth[next_state] = steps + 1
+            priority = steps + 1 + distance(next_state.pos, goal_pos)
+            heapq.heappush(
+                q, (priority, steps + 1, next(tiebreak), next_state)
+            )
 
-    # convert solution to NESW directions
-    directions = []
-    for s1, s2 in pairwise(solution[::-1]):
-        dr, dc = [a - b for a, b in zip(s2.pos, s1.pos)]
-        directions.append(DIR_TO_CMD[dr, dc])
+    return None, iterations
 
-    print(
-        f'found {len(directions)} move solution after {iterations} iterations',
-        file=sys.stderr
-    )
-    macro = ';'.join(directions)
-    print(macro)
 
-    assert macro == 'n;e;e;n;w;s;e;e;w;n;n;e'
+def prev_states(state: State, grid: Grid, start: State, goal_pos):
+    '''States which move into the given state (the inverse of next_states)'''
+
+    results = []
+    n = grid[state.pos]
+    for pos in neighbors(*state.pos, grid):
+        if pos == goal_pos:
+            continue
+
+        if pos == start.pos:
+            prev = start
+        else:
+            v = grid[pos]
+            prev = State(pos, 0, None if isinstance(v, int) else v)
+
+        if not isinstance(n, int):
+            prev = State(prev.pos, state.value, prev.op)
+        elif prev.op is None:
+            continue
+        elif (value := INVERSE_OPS[prev.op](state.value, n)) is None:
+            continue
+        else:
+            prev = State(prev.pos, value, prev.op)
+
+        if prev.pos == start.pos and prev != start:
+            continue
+        results.append(prev)
+    return results
+
+
+def solve_bidirectional(start_pos, goal_pos, goal_val, grid, max_steps):
+    '''Layered BFS from the start and backwards from the goal, meeting in the
+    middle. Multiplying by 0 can't be inverted, so grids containing a 0 use
+    the best-first search instead.'''
+
+    if any(v == 0 for v in grid.values()):
+        return solve_best_first(start_pos, goal_pos, goal_val, grid, max_steps)
+
+    bounds = Bounds(grid, goal_val, None)
+    start = State(start_pos, grid[start_pos])
+    goal = State(goal_pos, goal_val, None)
+
+    fwd = {start: None}  # state => parent (towards the start)
+    bwd = {goal: None}  # state => child (towards the goal)
+    fwd_layer, bwd_layer = [start], [goal]
+    fwd_depth = bwd_depth = 0
+    iterations = 0
+
+    while fwd_layer and bwd_layer:
+        if max_steps is not None and fwd_depth + bwd_depth >= max_steps:
+            break
+
+        expand_fwd = len(fwd_layer) <= len(bwd_layer)
+        layer, seen, other = (
+            (fwd_layer, fwd, bwd) if expand_fwd else (bwd_layer, bwd, fwd)
+        )
+
+        new_layer = []
+        meets = []
+        for state in layer:
+            iterations += 1
+            if expand_fwd:
+                candidates = [
+                    s for s in next_states(state, grid)
+                    if s.pos != start_pos and (
+                        s.pos != goal_pos or s.value == goal_val
+                    )
+                ]
+            else:
+                candidates = prev_states(state, grid, start, goal_pos)
+
+            for s in candidates:
+                if s in seen or not bounds.feasible(s, 0, goal_pos):
+                    continue
+                seen[s] = state
+                new_layer.append(s)
+                if s in other:
+                    meets.append(s)
+
+        if expand_fwd:
+            fwd_layer, fwd_depth = new_layer, fwd_depth + 1
+        else:
+            bwd_layer, bwd_depth = new_layer, bwd_depth + 1
+
+        if meets:
+            meet = min(meets)
+            path = []
+            state = meet
+            while state:
+                path.append(state.pos)
+                state = fwd[state]
+            path.reverse()
+            state = bwd[meet]
+            while state:
+                path.append(state.pos)
+                state = bwd[state]
+            return path, iterations
+
+    return None, iterations
+
+
+def generate_grid(n: int, seed: int | None = None):
+    '''Generate an n x n grid (n even) in the vault's checkerboard layout,
+    with numbers on odd squares and operators on even squares'''
+
+    rng = random.Random(seed)
+    return [
+        [
+            rng.randint(1, 20) if (r + c) % 2 else rng.choice('+-*')
+            for c in range(n)
+        ]
+        for r in range(n)
+    ]
+
+
+def benchmark(sizes: list[int], trials: int, seed: int = 0):
+    rng = random.Random(seed)
+    for n in sizes:
+        cases = [
+            (grid_from_list(generate_grid(n, rng.randrange(2**32))),
+             rng.randint(1, 100)) for _ in range(trials)
+        ]
+        for bidirectional in (False, True):
+            elapsed = 0.0
+            solved = 0
+            for grid, goal_val in cases:
+                start = time.perf_counter()
+                result = solve(
+                    (n - 1, 0),
+                    (0, n - 1),
+                    goal_val,
+                    grid,
+                    max_steps=4 * n,
+                    bidirectional=bidirectional,
+                )
+                elapsed += time.perf_counter() - start
+                solved += result is not None
+
+            name = 'bidirectional' if bidirectional else 'best-first'
+            print(
+                f'\033[93m{n}x{n} {name}: {solved}/{trials} solved, '
+                f'{elapsed / trials * 1000:.1f}ms avg\033[0m'
+            )
+
+
+@dataclass
+class VaultPuzzle:
+    grid_list: list[list[int | str]]
+    start_pos: tuple[int, int]
+    goal_pos: tuple[int, int]
+    goal_val: int
+
+    @property
+    def grid(self) -> Grid:
+        return grid_from_list(self.grid_list)
+
+    def solve(self, **kwargs):
+        return solve(
+            self.start_pos, self.goal_pos, self.goal_val, self.grid, **kwargs
+        )
+
+
+def parse_tile(desc: str) -> int | str | None:
+    '''Read the number or operator in a vault room's floor mosaic, or the
+    number carved into the antechamber's orb pedestal'''
+
+    if m := re.search(r"depicting the number '(\d+)'", desc):
+        return int(m.group(1))
+    if m := re.search(r"depicting a '(.)' symbol", desc):
+        return m.group(1)
+    if m := re.search(r"number '(\d+)' is carved into the orb's", desc):
+        return int(m.group(1))
+    return None
+
+
+def parse_exits(desc: str) -> list[str]:
+    m = re.search(r'There (?:is|are) \d+ exits?:\n(.*?)\n\n', desc, re.DOTALL)
+    return re.findall(r'- (.*)', m.group(1)) if m else []
+
+
+def room_title(desc: str) -> str | None:
+    m = re.search(r'== (.*?) ==', desc)
+    return m.group(1) if m else None
+
+
+_room_cache: OrderedDict[str, dict[tuple[int, int], tuple[VM, str]]] = (
+    OrderedDict()
+)
+
+
+def explore_vault(vm: VM) -> dict[tuple[int, int], tuple[VM, str]]:
+    '''Walk every vault room reachable from the antechamber (where the VM
+    must be standing, before taking the orb) using VM clones. Returns each
+    room's clone and description, keyed by its (row, col) offset from the
+    antechamber. Results are cached by memory image.'''
+
+    key = memory_hash(vm.memory)
+    if key in _room_cache:
+        _room_cache.move_to_end(key)
+        return _room_cache[key]
+
+    start = vm.clone().flush().send('look')
+    desc = start.read()
+    assert room_title(desc) == VAULT_TITLES[0], 'Not in the vault antechamber'
+
+    rooms = {(0, 0): (start, desc)}
+    q = [(0, 0)]
+    while q:
+        pos = q.pop(0)
+        room, desc = rooms[pos]
+        for exit in parse_exits(desc):
+            if exit not in MOVES:
+                continue
+            dr, dc = MOVES[exit]
+            newpos = pos[0] + dr, pos[1] + dc
+            if newpos in rooms:
+                continue
+            n = room.sendcopy(exit)
+            ndesc = n.read()
+            if room_title(ndesc) in VAULT_TITLES:
+                rooms[newpos] = n, ndesc
+                q.append(newpos)
+
+    _room_cache[key] = rooms
+    if len(_room_cache) > ROOM_CACHE_SIZE:
+        _room_cache.popitem(last=False)
+    return rooms
+
+
+def extract_puzzle(vm: VM) -> VaultPuzzle:
+    '''Build the vault puzzle from the room descriptions, cached on disk per
+    binary'''
+
+    cache = {}
+    if VAULT_CACHE.exists():
+        cache = json.loads(VAULT_CACHE.read_text())
+    if vm.binary_hash in cache:
+        data = cache[vm.binary_hash]
+        return VaultPuzzle(
+            data['grid'],
+            tuple(data['start']),
+            tuple(data['goal']),
+            data['goal_val'],
+        )
+
+    rooms = explore_vault(vm)
+    top = min(r for r, _ in rooms)
+    left = min(c for _, c in rooms)
+    rows = max(r for r, _ in rooms) - top + 1
+    cols = max(c for _, c in rooms) - left + 1
+
+    grid_list: list[list[int | str]] = [[0] * cols for _ in range(rows)]
+    goal_pos = goal_val = None
+    for (r, c), (_, desc) in rooms.items():
+        tile = parse_tile(desc)
+        assert tile is not None, f'Unreadable vault room:\n{desc}'
+        grid_list[r - top][c - left] = tile
+        if room_title(desc) == VAULT_TITLES[2]:
+            m = re.search(r"large '(\d+)' carved into it", desc)
+            assert m, 'Missing vault door number'
+            goal_pos, goal_val = (r - top, c - left), int(m.group(1))
+
+    assert goal_pos and goal_val is not None, 'Vault door not found'
+    assert len(rooms) == rows * cols, 'Vault rooms do not form a grid'
+    puzzle = VaultPuzzle(grid_list, (-top, -left), goal_pos, goal_val)
+
+    if vm.binary_hash is not None:
+        cache[vm.binary_hash] = {
+            'grid': puzzle.grid_list,
+            'start': puzzle.start_pos,
+            'goal': puzzle.goal_pos,
+            'goal_val': puzzle.goal_val,
+        }
+        VAULT_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        VAULT_CACHE.write_text(json.dumps(cache, indent=2))
+    return puzzle
+
+
+def solve_vm(vm: VM) -> str:
+    '''Extract and solve the vault puzzle from a VM standing in the
+    antechamber, returning the moves as a macro'''
+
+    directions = extract_puzzle(vm).solve(bidirectional=True)
+    assert directions, 'No vault solution found'
+    return ';'.join(directions)
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--max-steps', type=int)
+    parser.add_argument('-b', '--bidirectional', action='store_true')
+    parser.add_argument(
+        '--benchmark',
+        type=int,
+        nargs='*',
+        metavar='SIZE',
+        help='Benchmark on generated grids of the given (even) sizes',
+    )
+    parser.add_argument('-t', '--trials', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark(args.benchmark or [4, 6, 8, 10], args.trials)
+        return
+
     goal_val = 30  # target value to reach
     goal_pos = (0, 3)  # end at the upper right corner
     start_pos = (3, 0)  # start at the lower left corner
 
-    solve(start_pos, goal_pos, goal_val)
+    directions = solve(
+        start_pos,
+        goal_pos,
+        goal_val,
+        max_steps=args.max_steps,
+        bidirectional=args.bidirectional,
+    )
+    assert directions, 'No solution found'
+
+    macro = ';'.join(directions)
+    print(macro)
+
+    assert macro == 'n;e;e;n;w;s;e;e;w;n;n;e'
 
 
 if __name__ == '__main__':
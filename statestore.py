@@ -0,0 +1,176 @@
+'''Compact storage for many VM states.
+
+StateStore maps keys (e.g. locations) to VMs, but only keeps each state as a
+delta against a shared base memory image: the memory words which differ from
+the base (found by comparing 256-word pages, then the words of pages which
+differ) plus the rest of the VM snapshot. VMs are materialized lazily when
+read, the most recently used ones are kept in a small LRU, and once more than
+`max_resident` deltas are held, the least recently used are spilled to disk.
+
+Stored states are equivalent to `vm.clone()`. A materialized VM is shared by
+later reads of the same key while it stays hot, so treat it as read-only (or
+clone it) and store it again to update the state.
+'''
+import pickle
+import tempfile
+from array import array
+from collections import OrderedDict
+from collections.abc import Hashable, Iterator, MutableMapping
+from dataclasses import dataclass
+from pathlib import Path
+
+from vm import VM
+
+PAGE_SIZE = 256
+HOT_SIZE = 8
+MAX_RESIDENT = 1024
+
+
+@dataclass
+class Delta:
+    cls: type[VM]
+    addrs: array  # addresses which differ from the base
+    values: array
+    state: dict  # the VM snapshot without memory
+
+    @property
+    def nbytes(self):
+        return (len(self.addrs) + len(self.values)) * 2
+
+
+def memory_delta(base: list[int], memory: list[int]) -> tuple[array, array]:
+    assert len(base) == len(memory), 'Memory size differs from the base image'
+
+    addrs, values = array('H'), array('H')
+    for start in range(0, len(memory), PAGE_SIZE):
+        end = start + PAGE_SIZE
+        if memory[start:end] != base[start:end]:
+            for addr in range(start, min(end, len(memory))):
+                if memory[addr] != base[addr]:
+                    addrs.append(addr)
+                    values.append(memory[addr])
+    return addrs, values
+
+
+class StateStore(MutableMapping):
+
+    def __init__(
+        self,
+        base: list[int] | None = None,
+        hot_size=HOT_SIZE,
+        max_resident=MAX_RESIDENT,
+    ):
+        self.base = list(base) if base is not None else None
+        self.hot_size = hot_size
+        self.max_resident = max_resident
+        # key => in-memory delta, or the file it was spilled to
+        self.entries: dict[Hashable, Delta | Path] = {}
+        self.resident: OrderedDict[Hashable, None] = OrderedDict()
+        self.hot: OrderedDict[Hashable, VM] = OrderedDict()
+        self.spill_dir: tempfile.TemporaryDirectory | None = None
+        self.nspilled = 0
+
+    def delta(self, vm: VM) -> Delta:
+        if self.base is None:
+            self.base = list(vm.memory)
+        state = vm.snapshot()
+        addrs, values = memory_delta(self.base, state.pop('memory'))
+        return Delta(type(vm), addrs, values, state)
+
+    def materialize(self, delta: Delta) -> VM:
+        assert self.base is not None
+        memory = list(self.base)
+        for addr, value in zip(delta.addrs, delta.values):
+            memory[addr] = value
+        return delta.cls.from_snapshot(delta.state | {'memory': memory})
+
+    # ============
+    # Mapping API
+    # ============
+
+    def __getitem__(self, key) -> VM:
+        if key in self.hot:
+            self.hot.move_to_end(key)
+            return self.hot[key]
+
+        vm = self.materialize(self.load(key))
+        self.hot[key] = vm
+        if len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+        return vm
+
+    def __setitem__(self, key, vm: VM):
+        self.discard(key)
+        self.entries[key] = self.delta(vm)
+        self.resident[key] = None
+        self.spill()
+
+    def __delitem__(self, key):
+        if key not in self.entries:
+            raise KeyError(key)
+        self.discard(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self) -> Iterator:
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if isinstance(entry, Path):
+            entry.unlink(missing_ok=True)
+        self.resident.pop(key, None)
+        self.hot.pop(key, None)
+
+    # ==========
+    # Disk Spill
+    # ==========
+
+    def load(self, key) -> Delta:
+        '''Return the delta for key, reading it back from disk if spilled'''
+
+        entry = self.entries[key]
+        if isinstance(entry, Path):
+            delta = pickle.loads(entry.read_bytes())
+            entry.unlink()
+            self.entries[key] = delta
+            self.resident[key] = None
+            self.spill()
+            return delta
+
+        self.resident.move_to_end(key)
+        return entry
+
+    def spill(self):
+        '''Write the least recently used deltas to disk until at most
+        max_resident are held in memory'''
+
+        while len(self.resident) > self.max_resident:
+            key, _ = self.resident.popitem(last=False)
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.TemporaryDirectory(prefix='states-')
+            path = Path(self.spill_dir.name) / f'{self.nspilled}.pkl'
+            self.nspilled += 1
+            path.write_bytes(pickle.dumps(self.entries[key], protocol=5))
+            self.entries[key] = path
+
+    def close(self):
+        if self.spill_dir is not None:
+            self.spill_dir.cleanup()
+            self.spill_dir = None
+        self.entries.clear()
+        self.resident.clear()
+        self.hot.clear()
+
+    def stats(self) -> str:
+        resident = [e for e in self.entries.values() if isinstance(e, Delta)]
+        nbytes = sum(d.nbytes for d in resident)
+        return (
+            f'{len(self)} states, {len(resident)} in memory '
+            f'({nbytes / 1024:.1f} KiB of deltas), '
+            f'{len(self) - len(resident)} on disk, {len(self.hot)} hot'
+        )
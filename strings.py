@@ -1,32 +1,214 @@
+import argparse
+import re
 import string
+import sys
+import time
+from array import array
 
-from vm import VM
+from basevm import load_bytecode
+from bootcache import boot_vm
 
+PRINTABLE = string.printable.encode()
+PRINTABLE_RUN = re.compile(b'[' + re.escape(PRINTABLE) + b']+')
+PRINTABLE_ONLY = re.compile(b'[' + re.escape(PRINTABLE) + b']*')
 
-def strings(memory: list[int]):
-    addr_strs = {}
-    laddr = 0
+# maps a word's high byte to 0xff if it is zero (the word fits in one byte)
+HIGH_BYTE_ZERO = bytes([0xff] + [0] * 255)
 
-    for addr, v in enumerate(memory):
-        if v < 256 and chr(v) in string.printable:
-            addr_strs[laddr] = addr_strs.get(laddr, '') + chr(v)
-        else:
-            laddr = addr + 1
+# callback passed to the print routine which xors each char with r2:
+#   push r1; set r1 r2; call <xor>; out r0; pop r1; ret
+XOR_CALLBACK = [2, 32769, 1, 32769, 32770, 17, None, 19, 32768, 3, 32769, 18]
 
-    return addr_strs
+
+def pack_memory(memory: list[int]) -> bytes:
+    '''Pack memory into one byte per word, with words above 255 set to 0.
+    Uses bulk bytes/int operations instead of a per-word Python loop.'''
+
+    words = array('H', memory)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    data = words.tobytes()
+    low, high = data[0::2], data[1::2]
+    mask = int.from_bytes(high.translate(HIGH_BYTE_ZERO), 'little')
+    return (int.from_bytes(low, 'little') & mask).to_bytes(len(low), 'little')
+
+
+def strings(memory: list[int], min_len: int = 1) -> dict[int, str]:
+    '''Find all runs of printable values in memory, keyed by address'''
+
+    packed = pack_memory(memory)
+    return {
+        m.start(): m.group().decode()
+        for m in PRINTABLE_RUN.finditer(packed)
+        if len(m.group()) >= min_len
+    }
+
+
+def find_words(memory: list[int], pattern: list[int | None]) -> list[int]:
+    '''Find all addresses matching a word pattern (None matches any word)'''
+
+    words = array('H', memory)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    regex = b''.join(
+        b'..' if w is None else re.escape(w.to_bytes(2, 'little'))
+        for w in pattern
+    )
+    return [
+        m.start() // 2
+        for m in re.finditer(b'(?=' + regex + b')', words.tobytes(), re.DOTALL)
+        if m.start() % 2 == 0
+    ]
+
+
+def length_prefixed(memory: list[int], packed: bytes, addr: int) -> str | None:
+    '''Return the printable length-prefixed string at addr, if there is one'''
+
+    n = memory[addr]
+    if not 0 < n < 256 or addr + n >= len(memory):
+        return None
+    chunk = packed[addr + 1:addr + 1 + n]
+    return chunk.decode() if PRINTABLE_ONLY.fullmatch(chunk) else None
+
+
+def string_tables(memory: list[int], min_len: int = 2) -> dict[int, str]:
+    '''Find plaintext length-prefixed strings, keyed by the address of their
+    length word. A string only counts if it is followed by a non-printable
+    word or by another length-prefixed string, which rejects most false
+    positives inside ordinary printable runs.'''
+
+    packed = pack_memory(memory)
+    found = {}
+    addr = 0
+    while addr < len(memory):
+        s = length_prefixed(memory, packed, addr)
+        if s is None or len(s) < min_len:
+            addr += 1
+            continue
+
+        end = addr + 1 + len(s)
+        if end < len(memory) and packed[end] in PRINTABLE and (
+            length_prefixed(memory, packed, end) is None
+        ):
+            addr += 1
+            continue
+
+        found[addr] = s
+        addr = end
+    return found
+
+
+def encrypted_strings(memory: list[int]) -> dict[int, tuple[int, str]]:
+    '''Decode strings printed through the xor callback, keyed by the address
+    of their length word. Each call site looks like:
+
+        set r0 <str>; set r1 <xor callback>; add r2 <a> <b>; call <print>
+
+    and prints each char of the length-prefixed string xor'd with a + b.'''
+
+    found = {}
+    for callback in find_words(memory, XOR_CALLBACK):
+        sites = [
+            (addr, memory[addr + 8] + memory[addr + 9])
+            for addr in find_words(
+                memory,
+                [1, 32768, None, 1, 32769, callback, 9, 32770, None, None, 17],
+            )
+        ] + [
+            (addr, memory[addr + 8])
+            for addr in find_words(
+                memory,
+                [1, 32768, None, 1, 32769, callback, 1, 32770, None, 17],
+            )
+        ]
+
+        for site, key in sites:
+            # the raw (unbooted) image holds still-encoded call sites whose
+            # operands can point past the end of memory
+            addr = memory[site + 2]
+            if addr >= len(memory) or addr + memory[addr] >= len(memory):
+                continue
+            key %= 32768
+            n = memory[addr]
+            found[addr] = key, ''.join(
+                chr(memory[addr + 1 + i] ^ key) for i in range(n)
+            )
+    return found
+
+
+def check(binfile='challenge.bin', use_cache=True):
+    '''Run every scanner on both the raw and the booted image, making sure
+    none of them fails and that the booted image's strings are found'''
+
+    images = {
+        'raw': load_bytecode(binfile),
+        'booted': boot_vm(binfile, use_cache).memory,
+    }
+    for name, memory in images.items():
+        counts = {
+            'strings': len(strings(memory)),
+            'tables': len(string_tables(memory)),
+            'encrypted': len(encrypted_strings(memory)),
+        }
+        summary = ', '.join(f'{n} {kind}' for kind, n in counts.items())
+        print(f'\033[92mok\033[0m {name:<6} {summary}')
+        assert name == 'raw' or counts['encrypted'], (
+            f'No encrypted strings found in the {name} image'
+        )
 
 
 def main():
-    vm = VM('challenge.bin')
-    vm.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    parser.add_argument('-m', '--min-len', type=int, default=2)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '-t',
+        '--tables',
+        action='store_true',
+        help='Only print length-prefixed strings',
+    )
+    mode.add_argument(
+        '-e',
+        '--encrypted',
+        action='store_true',
+        help='Decode strings printed with the xor callback',
+    )
+    mode.add_argument(
+        '--check',
+        action='store_true',
+        help='Check that every scanner runs on the raw and booted image',
+    )
+    args = parser.parse_args()
+
+    if args.check:
+        return check(args.file, use_cache=not args.no_cache)
+
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
 
-    addr_strs = strings(vm.memory)
+    start = time.perf_counter()
+    if args.encrypted:
+        found = {
+            addr: s for addr, (_, s) in encrypted_strings(vm.memory).items()
+        }
+    elif args.tables:
+        found = string_tables(vm.memory, args.min_len)
+    else:
+        found = strings(vm.memory, args.min_len)
+    elapsed = time.perf_counter() - start
 
-    MIN_STR_LEN = 2
+    for addr, s in found.items():
+        print(addr, repr(s))
 
-    for addr, s in addr_strs.items():
-        if len(s) >= MIN_STR_LEN:
-            print(addr, repr(s))
+    print(
+        f'found {len(found)} strings in {elapsed * 1000:.1f}ms',
+        file=sys.stderr
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,275 @@
+'''Record/replay (time travel) for the VM.
+
+RecordingVM counts executed instructions (steps) and logs every input buffer
+assignment and memory write with the step it happened at. Every `interval`
+steps it takes a checkpoint, which shares unchanged 256-word memory pages with
+the previous checkpoint. Travelling to step K restores the last checkpoint at
+or before K and replays forward with the logged input, so moving backward
+costs at most one checkpoint interval.
+
+After travelling, the VM stays paused at that step (so it can be inspected)
+until the next game command is sent, which resumes execution and discards the
+recorded future. Debug commands which change the VM state (e.g. `.wm`) also
+discard the future and force a checkpoint.
+'''
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from typing import override
+
+from basevm import Registers
+from vm import VM
+
+PAGE_SIZE = 256
+DEFAULT_INTERVAL = 10000
+
+# attributes stored explicitly in checkpoints, or not part of the VM state
+EXCLUDED_ATTRS = {
+    'memory', 'registers', 'stack', 'pc', '_input', 'output', 'live_output',
+    'tracing', 'history', 'paused', 'watcher', 'execute'
+}
+
+
+@dataclass
+class Checkpoint:
+    step: int
+    pages: tuple[tuple[int, ...], ...]
+    registers: list[int]
+    stack: list[int]
+    pc: int
+    input: list[str]
+    extras: dict
+
+
+@dataclass
+class Write:
+    step: int
+    pc: int
+    addr: int
+    old: int
+    new: int
+
+
+@dataclass
+class History:
+    interval: int = DEFAULT_INTERVAL
+    step: int = 0
+    end: int = 0  # furthest step recorded
+    checkpoints: list[Checkpoint] = field(default_factory=list)
+    inputs: dict[int, list[str]] = field(default_factory=dict)
+    writes: list[Write] = field(default_factory=list)
+    replaying: bool = False
+    traveled: bool = False
+
+    def truncate(self, step: int):
+        '''Forget everything recorded after the given step'''
+
+        self.checkpoints = [c for c in self.checkpoints if c.step <= step]
+        self.inputs = {s: i for s, i in self.inputs.items() if s <= step}
+        self.writes = [w for w in self.writes if w.step < step]
+        self.end = step
+
+
+class RecordingVM(VM):
+
+    # recording state, which macro checkpoints neither key on nor restore
+    SESSION_ATTRS = ('history', 'paused')
+
+    def __init__(self, *args, interval=DEFAULT_INTERVAL, **kwargs):
+        self.history = History(interval)
+        self.paused = False
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def from_vm(cls, vm: VM, interval=DEFAULT_INTERVAL):
+        rvm = cls(interval=interval)
+        rvm.apply_snapshot(vm.snapshot())
+        for k, v in vars(vm).items():
+            if k not in EXCLUDED_ATTRS and k != 'input':
+                setattr(rvm, k, v)
+        rvm.checkpoint()
+        return rvm
+
+    # the input buffer is replaced on every send; log each replacement so
+    # replays see the same input
+    @property
+    def input(self) -> list[str]:
+        return self._input
+
+    @input.setter
+    def input(self, value: list[str]):
+        self._input = value
+        history = getattr(self, 'history', None)
+        if history and not history.replaying:
+            if history.step < history.end:
+                history.truncate(history.step)
+            history.inputs[history.step] = list(value)
+
+    # =========
+    # Recording
+    # =========
+
+    @override
+    def step(self) -> bool:
+        return False if self.paused else super().step()
+
+    @override
+    def execute(self, opcode, args):
+        history = self.history
+        if not history.replaying:
+            if history.step < history.end:
+                history.truncate(history.step)
+            if history.step % history.interval == 0 and (
+                not history.checkpoints
+                or history.checkpoints[-1].step != history.step
+            ):
+                self.checkpoint()
+            if opcode.name == 'wmem':
+                addr = self.value(args[0])
+                history.writes.append(
+                    Write(
+                        history.step, self.pc, addr, self.memory[addr],
+                        self.value(args[1])
+                    )
+                )
+
+        result = super().execute(opcode, args)
+        if result:
+            history.step += 1
+            history.end = max(history.end, history.step)
+        return result
+
+    def checkpoint(self):
+        '''Checkpoint the current step, sharing unchanged memory pages with
+        the previous checkpoint'''
+
+        history = self.history
+        prev = history.checkpoints[-1].pages if history.checkpoints else ()
+        pages = []
+        for i, start in enumerate(range(0, len(self.memory), PAGE_SIZE)):
+            page = tuple(self.memory[start:start + PAGE_SIZE])
+            if i < len(prev) and prev[i] == page:
+                page = prev[i]
+            pages.append(page)
+
+        checkpoint = Checkpoint(
+            step=history.step,
+            pages=tuple(pages),
+            registers=list(self.registers._regs),
+            stack=list(self.stack),
+            pc=self.pc,
+            input=list(self._input),
+            extras={
+                k: v
+                for k, v in vars(self).items() if k not in EXCLUDED_ATTRS
+            },
+        )
+
+        # a checkpoint forced at an existing step replaces the old one
+        while history.checkpoints and history.checkpoints[-1].step >= (
+            history.step
+        ):
+            history.checkpoints.pop()
+        history.checkpoints.append(checkpoint)
+
+    def fingerprint(self):
+        extras = {k: v for k, v in vars(self).items() if k not in EXCLUDED_ATTRS}
+        return (
+            list(self.memory),
+            list(self.registers._regs),
+            list(self.stack),
+            self.pc,
+            extras,
+        )
+
+    @override
+    def send(self, cmd) -> 'VM':
+        if ';' in cmd:
+            return super().send(cmd)
+
+        if not cmd.startswith('.'):
+            self.paused = False
+            return super().send(cmd)
+
+        # debug commands which change state invalidate the recorded future
+        before = self.fingerprint()
+        self.history.traveled = False
+        super().send(cmd)
+        if not self.history.traveled and self.fingerprint() != before:
+            self.history.truncate(self.history.step)
+            self.checkpoint()
+        return self
+
+    # ===========
+    # Time Travel
+    # ===========
+
+    def restore(self, checkpoint: Checkpoint):
+        self.memory = [w for page in checkpoint.pages for w in page]
+        self.registers = Registers(list(checkpoint.registers))
+        self.stack = list(checkpoint.stack)
+        self.pc = checkpoint.pc
+        self._input = list(checkpoint.input)
+        for k, v in checkpoint.extras.items():
+            setattr(self, k, v)
+        self.history.step = checkpoint.step
+
+    def travel(self, step: int):
+        '''Restore the state before the given step executes, replaying from
+        the nearest checkpoint'''
+
+        history = self.history
+        assert 0 <= step <= history.end, (
+            f'Step {step} is outside the recorded range 0..{history.end}'
+        )
+        steps = [c.step for c in history.checkpoints]
+        idx = bisect_right(steps, step) - 1
+        assert idx >= 0, f'No checkpoint at or before step {step}'
+
+        self.restore(history.checkpoints[idx])
+        history.replaying = True
+        try:
+            while history.step < step:
+                if (inp := history.inputs.get(history.step)) is not None:
+                    self._input = list(inp)
+                if not super().step():
+                    break
+        finally:
+            history.replaying = False
+
+        self.output = ''
+        self.paused = True
+        history.traveled = True
+        return history.step - steps[idx]
+
+    def back(self, n: int):
+        return self.travel(max(self.history.step - n, 0))
+
+    def back_to_write(self, addr: int) -> Write:
+        '''Travel to just before the last write to addr'''
+
+        write = next(
+            (
+                w for w in reversed(self.history.writes)
+                if w.addr == addr and w.step < self.history.step
+            ),
+            None,
+        )
+        assert write, f'No recorded write to {addr}'
+        self.travel(write.step)
+        return write
+
+    def status(self):
+        history = self.history
+        shared = len({id(p) for c in history.checkpoints for p in c.pages})
+        return (
+            f'step {history.step}/{history.end}, pc {self.pc}, '
+            f'{len(history.checkpoints)} checkpoints ({shared} distinct pages), '
+            f'{len(history.writes)} writes logged'
+        )
+
+
+def recording(vm: VM) -> RecordingVM:
+    assert isinstance(vm, RecordingVM), (
+        'Recording is off (start run.py with --record)'
+    )
+    return vm
@@ -1,13 +1,12 @@
 import ast
 import bdb
-import re
-import readline
+import hashlib
+import json
 from itertools import zip_longest
 from pathlib import Path
 from typing import TypedDict, override
 
-from basevm import BaseVM, Registers, read_instruction
-from disassembler import disassemble, format_instruction_plain
+from basevm import CACHE_ROOT, BaseVM, Registers, read_instruction
 
 ALIASES = {
     'l': 'look',
@@ -23,6 +22,7 @@ ALIASES = {
 }
 
 SNAPSHOTS_DIR = Path('snapshots')
+TELEPORTER_CACHE = CACHE_ROOT / 'teleporter.json'
 
 
 class VMSnapshot(TypedDict):
@@ -33,15 +33,25 @@ class VMSnapshot(TypedDict):
     input: list[str]
     output: str
     location_addr: int | None
+    binary_hash: str | None
+
+
+def file_hash(fname: str | Path) -> str:
+    with open(fname, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
 class VM(BaseVM):
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, binfile=None):
+        super().__init__(binfile)
+        self.binary_hash = file_hash(binfile) if binfile else None
         self.location_addr = None
         self.teleport_call_addr = None
+        self.teleport_expected = 6
+        self.teleport_r7 = 0
         self.tracing = False
+        self.watcher = None
 
     # =================
     # Location Tracking
@@ -61,10 +71,34 @@ class VM(BaseVM):
         assert self.location_addr is not None, 'Location address not set'
         self.memory[self.location_addr] = value
 
+    def goto(self, room: str | int) -> str:
+        '''Walk to the nearest room with the given title (or location id)
+        along a shortest path in this binary's world graph, returning the
+        macro that was sent. Arrival is checked after every move: a move
+        which ends up elsewhere is dropped from the graph and the route is
+        replanned from wherever the VM is.'''
+
+        from worldgraph import world_graph
+        world = world_graph(self.binary_hash)
+        sent = []
+        while moves := world.route_to(self.location, room):
+            src, move = self.location, moves[0]
+            self.send(move)
+            sent.append(move)
+            if self.location != world.edges[src][move]:
+                world.drop_edge(src, move)
+        assert moves is not None, f'No known route to {room!r}'
+        return ';'.join(sent)
+
     # ==============
     # Input Handling
     # ==============
 
+    @override
+    def interactive(self):
+        import readline  # noqa: F401 (line editing for input())
+        super().interactive()
+
     def sendcopy(self, cmd) -> 'VM':
         '''Sends a command to a copy of the current VM, returning the new VM'''
 
@@ -98,20 +132,67 @@ class VM(BaseVM):
     @override
     def execute(self, opcode, args):
         if self.tracing:
+            from disassembler import format_instruction_plain
             opcode, args = read_instruction(self.memory, self.pc)
             print(self.pc, format_instruction_plain(opcode, args))
 
-        # skip slow call but set the proper post-exec values
+        # skip slow call but set the proper post-exec values. the function
+        # returns through its base case (r0 = r1 + 1), so r1 = r0 - 1
         if opcode.name == 'call' and args[0] == self.teleport_call_addr:
             self.pc += len(opcode)
-            self.registers[0] = 6
-            self.registers[1] = 5
-            self.registers[7] = 25734  # secret value
+            self.registers[0] = self.teleport_expected
+            self.registers[1] = self.teleport_expected - 1
+            self.registers[7] = self.teleport_r7
             return True
         return super().execute(opcode, args)
 
-    def patch_teleporter_call(self):
+    def patch_teleporter_call(self) -> int:
+        '''Skip the teleporter check routine, returning the r7 value it
+        expects (solved from the call site, cached on disk)'''
+
         self.teleport_call_addr = find_teleporter_call(self.memory)
+        r0, r1, expected = find_teleporter_params(
+            self.memory, self.teleport_call_addr
+        )
+        self.teleport_expected = expected
+        self.teleport_r7 = solve_teleporter_r7(
+            self.binary_hash, r0, r1, expected
+        )
+        return self.teleport_r7
+
+    # ===========
+    # Watchpoints
+    # ===========
+
+    def watchpoints(self):
+        if self.watcher is None:
+            from watchpoints import Watcher
+            self.watcher = Watcher()
+        return self.watcher
+
+    def watch(self, start: int, end: int | None = None, kinds='w'):
+        '''Watch reads ('r'), writes ('w') and/or changes ('c') of the
+        addresses in [start, end)'''
+
+        from watchpoints import parse_kinds
+        end = start + 1 if end is None else end
+        self.watchpoints().add(start, end, parse_kinds(kinds))
+        self.update_watching()
+        return self.watcher
+
+    def update_watching(self):
+        '''Install the watching execute path only while a watch or the
+        heatmap is active, so unwatched VMs pay nothing for watchpoints'''
+
+        if self.watcher is not None and self.watcher.active:
+            self.execute = self.execute_watched
+        else:
+            vars(self).pop('execute', None)
+
+    def execute_watched(self, opcode, args):
+        if opcode.name in ('rmem', 'wmem'):
+            self.watcher.check(self, opcode, args)
+        return type(self).execute(self, opcode, args)
 
     # ============
     # Snapshotting
@@ -132,6 +213,7 @@ class VM(BaseVM):
             'input': list(self.input),
             'output': self.output,
             'location_addr': self.location_addr,
+            'binary_hash': self.binary_hash,
         }
 
     def apply_snapshot(self, snapshot: VMSnapshot):
@@ -142,6 +224,7 @@ class VM(BaseVM):
         self.input = list(snapshot['input'])
         self.output = snapshot['output']
         self.location_addr = snapshot['location_addr']
+        self.binary_hash = snapshot.get('binary_hash')
         return self
 
     @classmethod
@@ -166,6 +249,8 @@ class VM(BaseVM):
 
 
 def debug_cmd(vm: VM, cmd: str):
+    from disassembler import align, disassemble, disassemble_window
+
     match cmd.split():
         case ['bp' | 'breakpoint']:
             try:
@@ -181,24 +266,27 @@ def debug_cmd(vm: VM, cmd: str):
                 f.write(repr(vm))
             print('saved to', fname)
 
-        case ['save', *fname]:
-            fname = fname or ['last']
-            SNAPSHOTS_DIR.mkdir(exist_ok=True)
-            fname = SNAPSHOTS_DIR / fname[0]
-            vm.write_snapshot_file(fname)
-            print('saved snapshot to', fname)
-
-        case ['load', fname]:
-            fname = SNAPSHOTS_DIR / fname
-            vm.apply_snapshot_file(fname)
-            print('restored snapshot from', fname)
-
-        case ['diff', fname1, *fnames]:
-            vm1 = vm.from_snapshot_file(SNAPSHOTS_DIR / fname1)
-            vm2 = vm
-            if fnames:
-                vm2 = vm.from_snapshot_file(SNAPSHOTS_DIR / fnames[0])
-            __import__('pprint').pprint(diff_vms(vm1, vm2))
+        case ['save', *name]:
+            from snapshot_repo import SnapshotRepo
+            name = name[0] if name else 'last'
+            new = SnapshotRepo().save(name, vm.snapshot())
+            print(f'saved snapshot {name} ({new} new pages)')
+
+        case ['load', name]:
+            from snapshot_repo import SnapshotRepo
+            vm.apply_snapshot(SnapshotRepo().load(name))
+            print('restored snapshot', name)
+
+        case ['diff', name1, *names]:
+            from snapshot_repo import SnapshotRepo
+            other = names[0] if names else vm.snapshot()
+            __import__('pprint').pprint(SnapshotRepo().diff(name1, other))
+
+        case ['snapshots']:
+            from snapshot_repo import SnapshotRepo
+            repo = SnapshotRepo()
+            print('\n'.join(repo.names()))
+            print(repo.stats())
 
         # write value to the STACK at address (0 = the bottom)
         case ['ws', addr, val]:
@@ -233,6 +321,73 @@ def debug_cmd(vm: VM, cmd: str):
             print('changing location to:', newloc)
             vm.location = int(newloc)
 
+        case ['back', n]:
+            from timetravel import recording
+            rvm = recording(vm)
+            replayed = rvm.back(int(n))
+            print(f'replayed {replayed} steps:', rvm.status())
+
+        case ['back-to-write', addr]:
+            from timetravel import recording
+            rvm = recording(vm)
+            w = rvm.back_to_write(int(addr))
+            print(f'before write @ {w.pc}: mem[{w.addr}] = {w.old} => {w.new}')
+            print(rvm.status())
+
+        case ['goto-step']:
+            from timetravel import recording
+            print(recording(vm).status())
+
+        case ['goto-step', step]:
+            from timetravel import recording
+            rvm = recording(vm)
+            replayed = rvm.travel(int(step))
+            print(f'replayed {replayed} steps:', rvm.status())
+
+        case ['watch']:
+            watcher = vm.watchpoints()
+            print('watching:', ', '.join(watcher.summary()) or 'nothing')
+            for hit in watcher.hits[-20:]:
+                print(hit)
+
+        case ['watch', 'clear']:
+            vm.watchpoints().clear()
+            vm.update_watching()
+
+        case ['watch', 'rm', rng]:
+            from watchpoints import parse_range
+            vm.watchpoints().remove(*parse_range(rng))
+            vm.update_watching()
+
+        case ['watch', rng, *kinds]:
+            from watchpoints import parse_range
+            kinds = kinds[0] if kinds else 'w'
+            watcher = vm.watch(*parse_range(rng), kinds=kinds)
+            watcher.verbose = True
+            print('watching:', ', '.join(watcher.summary()))
+
+        case ['heatmap', 'on' | 'off' as state]:
+            watcher = vm.watchpoints()
+            if state == 'on':
+                watcher.start_heatmap()
+            else:
+                watcher.stop_heatmap()
+            vm.update_watching()
+            print('heatmap', state)
+
+        case ['heatmap', *n]:
+            from watchpoints import PAGE_SIZE
+            n = int(n[0]) if n else 20
+            for page, reads, writes in vm.watchpoints().heatmap()[:n]:
+                start = page * PAGE_SIZE
+                print(
+                    f'{start:>5}-{start + PAGE_SIZE - 1:<5}  '
+                    f'{reads:>9} reads {writes:>9} writes'
+                )
+
+        case ['goto', *room]:
+            print('walking:', vm.goto(' '.join(room)) or '(already there)')
+
         case ['dis']:
             disassemble(vm.memory, vm.pc, 15)
 
@@ -240,24 +395,36 @@ def debug_cmd(vm: VM, cmd: str):
             disassemble(vm.memory, vm.pc, int(lines))
 
         case ['dis', lines, addr]:
-            disassemble(vm.memory, int(addr), int(lines))
+            disassemble(vm.memory, align(vm.memory, int(addr)), int(lines))
 
-        case ['macro', fname]:
+        case ['disw', addr, *size]:
+            size = int(size[0]) if size else 10
+            for line in disassemble_window(vm.memory, int(addr), size, size):
+                print(line)
+
+        case ['macro', fname, *interval]:
+            from macro_runner import DEFAULT_INTERVAL, read_macro, run_macro
             fname = Path('macros') / fname
             print('running macros from:', fname)
+            interval = int(interval[0]) if interval else DEFAULT_INTERVAL
+            run_macro(vm, read_macro(fname), interval)
 
-            with open(fname) as f:
-                commands = re.split(r'[\n;]+', f.read().strip())
+        case ['xref', addr]:
+            from xrefs import print_xrefs, xref_index
+            index = xref_index(vm.memory, vm.binary_hash)
+            print_xrefs(vm.memory, int(addr), index)
+
+        case ['xref-profile', *cmds]:
+            from xrefs import add_profile, profile_commands
+            commands = [c.strip() for c in ' '.join(cmds).split(',')]
+            profile = profile_commands(vm, commands)
+            add_profile(vm.memory, profile, vm.binary_hash)
+            print(f'merged {len(profile)} dynamic references')
 
-            for i, cmd in enumerate(commands):
-                print(
-                    f'\033[93m>>> [{i}/{len(commands)}] sending "{cmd}"\033[0m'
-                )
-                vm.send(cmd)
-                print(vm.read())
         case ['patch_teleporter']:
-            vm.patch_teleporter_call()
+            r7 = vm.patch_teleporter_call()
             print('Patching teleporter call @', vm.teleport_call_addr)
+            print('Teleporter expects r7 =', r7)
 
         case _:
             print('unknown debug command')
@@ -266,8 +433,8 @@ def debug_cmd(vm: VM, cmd: str):
 def diff_snapshots(snap1: VMSnapshot, snap2: VMSnapshot):
     result = {}
     for key in snap1:
-        v1 = snap1[key]
-        v2 = snap2[key]
+        v1 = snap1.get(key)
+        v2 = snap2.get(key)
 
         if v1 == v2:
             continue
@@ -313,6 +480,50 @@ def find_teleporter_call(memory: list[int]):
     return addrs[0]
 
 
+def find_teleporter_params(memory: list[int], func_addr: int):
+    '''Find the call site of the teleporter check and return the (r0, r1)
+    arguments it is called with and the r0 result it expects:
+
+        set r0 <r0>; set r1 <r1>; call <func_addr>; eq r1 r0 <expected>
+    '''
+
+    code = [1, 32768, None, 1, 32769, None, 17, func_addr, 4, 32769, 32768]
+    sites = find_memory_pattern(memory, code)
+    assert len(sites) == 1, f'Expected one teleporter call site, found {sites}'
+    site = sites[0]
+    r0, r1, expected = memory[site + 2], memory[site + 5], memory[site + 11]
+
+    from solve_teleporter import MAX_FAST_R0
+    if r0 > MAX_FAST_R0:
+        raise ValueError(
+            f'Teleporter check at {site} calls f({r0}, {r1}), but r7 can '
+            f'only be solved for r0 <= {MAX_FAST_R0}'
+        )
+    return r0, r1, expected
+
+
+def solve_teleporter_r7(binary_hash: str | None, r0, r1, expected) -> int:
+    '''Solve for the r7 value making f(r0, r1) == expected, caching the
+    answer on disk per binary'''
+
+    key = f'{binary_hash}:{r0}:{r1}:{expected}'
+    cache = {}
+    if TELEPORTER_CACHE.exists():
+        cache = json.loads(TELEPORTER_CACHE.read_text())
+    if key in cache:
+        return cache[key]
+
+    from solve_teleporter import solve_r7
+    solutions = solve_r7(r0, r1, expected)
+    assert solutions, f'No r7 makes f({r0}, {r1}) == {expected}'
+
+    if binary_hash is not None:
+        cache[key] = solutions[0]
+        TELEPORTER_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        TELEPORTER_CACHE.write_text(json.dumps(cache, indent=2))
+    return solutions[0]
+
+
 def calculate_location_addr(vm: VM) -> int:
     '''Identify the memory addresss which stores the VM's current location'''
 
@@ -320,11 +531,22 @@ def calculate_location_addr(vm: VM) -> int:
     desc = vm.clone().flush().sendcopy('look').read()
     assert 'Definitely no treasure within!' in desc, 'Unexpected location for location address calculation'
 
-    vm1 = vm.clone().run()
-    vm2 = vm.clone().sendcopy('doorway')
-    diff = diff_vms(vm1, vm2)
-
-    assert 'memory' in diff, 'Diff does not contain memory'
+    # watch for changes anywhere in memory while walking there and back.
+    # the location changes on every move and returns to its earlier value,
+    # unlike move counters, visited flags or the previous location
+    vm = vm.clone().flush()
+    watcher = vm.watch(0, len(vm.memory), 'c')
+    values = []
+    for move in ['doorway', 'north', 'south']:
+        watcher.hits.clear()
+        vm.send(move)
+        values.append({hit.addr: hit.new for hit in watcher.hits})
+
+    candidates = [
+        addr for addr in values[0]
+        if addr in values[1] and values[2].get(addr) == values[0][addr]
+    ]
+    assert candidates, 'No memory address tracks the location'
 
-    # assume lowest address (generally true but could be incorrect)
-    return min(d[0] for d in diff['memory'])
+    # several copies may track it; use the lowest
+    return min(candidates)
@@ -0,0 +1,149 @@
+'''Memory watchpoints and a per-page access heatmap.
+
+Watches are kept as per-address flags (read, write, change) in a bytearray
+covering the address space and are only consulted by `rmem` and `wmem`. A VM
+swaps in its watching execute path while a watch or the heatmap is active
+(see `VM.update_watching`), so a VM without watches runs the plain
+instruction loop.
+'''
+from dataclasses import dataclass
+
+READ, WRITE, CHANGE = 1, 2, 4
+KINDS = {'r': READ, 'w': WRITE, 'c': CHANGE}
+MEMORY_SIZE = 32768
+PAGE_SIZE = 256
+MAX_HITS = 10000
+
+
+@dataclass
+class Hit:
+    pc: int
+    kind: str  # 'r', 'w' or 'c'
+    addr: int
+    old: int
+    new: int
+
+    def __str__(self):
+        if self.kind == 'r':
+            return f'{self.pc:>5}  read  mem[{self.addr}] = {self.old}'
+        return (
+            f'{self.pc:>5}  write mem[{self.addr}] = {self.old} => {self.new}'
+        )
+
+
+def parse_kinds(kinds: str) -> int:
+    '''Convert a string like "rw" into a watch mask'''
+
+    assert kinds and set(kinds) <= set(KINDS), (
+        f'Unknown watch kind {kinds!r} (expected some of "rwc")'
+    )
+    mask = 0
+    for k in kinds:
+        mask |= KINDS[k]
+    return mask
+
+
+def format_kinds(mask: int) -> str:
+    return ''.join(k for k, bit in KINDS.items() if mask & bit)
+
+
+def parse_range(text: str) -> tuple[int, int]:
+    '''Parse "addr" or "start-end" (inclusive) into a half-open range'''
+
+    start, _, end = text.partition('-')
+    start = int(start)
+    end = int(end) + 1 if end else start + 1
+    assert 0 <= start < end <= MEMORY_SIZE, f'Invalid address range {text!r}'
+    return start, end
+
+
+class Watcher:
+
+    def __init__(self):
+        self.flags = bytearray(MEMORY_SIZE)
+        # (start, end) => watch mask
+        self.watches: dict[tuple[int, int], int] = {}
+        self.hits: list[Hit] = []
+        self.verbose = False  # print hits as they happen
+        # per-page access counts, None while the heatmap is off
+        self.reads: list[int] | None = None
+        self.writes: list[int] | None = None
+
+    @property
+    def active(self):
+        return bool(self.watches) or self.reads is not None
+
+    def add(self, start: int, end: int, mask: int):
+        self.watches[start, end] = self.watches.get((start, end), 0) | mask
+        for addr in range(start, end):
+            self.flags[addr] |= mask
+
+    def remove(self, start: int, end: int):
+        assert (start, end) in self.watches, f'No watch on {start}-{end - 1}'
+        del self.watches[start, end]
+        self.flags = bytearray(MEMORY_SIZE)
+        for (s, e), mask in self.watches.items():
+            for addr in range(s, e):
+                self.flags[addr] |= mask
+
+    def clear(self):
+        self.watches.clear()
+        self.flags = bytearray(MEMORY_SIZE)
+        self.hits.clear()
+
+    def start_heatmap(self):
+        npages = MEMORY_SIZE // PAGE_SIZE
+        self.reads = [0] * npages
+        self.writes = [0] * npages
+
+    def stop_heatmap(self):
+        self.reads = self.writes = None
+
+    def heatmap(self) -> list[tuple[int, int, int]]:
+        '''(page, reads, writes) for every accessed page, busiest first'''
+
+        assert self.reads is not None and self.writes is not None, (
+            'Heatmap is off'
+        )
+        pages = [
+            (page, r, w)
+            for page, (r, w) in enumerate(zip(self.reads, self.writes))
+            if r or w
+        ]
+        return sorted(pages, key=lambda p: p[1] + p[2], reverse=True)
+
+    def check(self, vm, opcode, args):
+        '''Record the memory access about to be made by an rmem/wmem'''
+
+        if opcode.name == 'rmem':
+            addr = vm.value(args[1])
+            if self.reads is not None:
+                self.reads[addr // PAGE_SIZE] += 1
+            if self.flags[addr] & READ:
+                value = vm.memory[addr]
+                self.hit(vm, Hit(vm.pc, 'r', addr, value, value))
+            return
+
+        addr = vm.value(args[0])
+        if self.writes is not None:
+            self.writes[addr // PAGE_SIZE] += 1
+        if flags := self.flags[addr]:
+            old, new = vm.memory[addr], vm.value(args[1])
+            if flags & WRITE:
+                self.hit(vm, Hit(vm.pc, 'w', addr, old, new))
+            elif flags & CHANGE and old != new:
+                self.hit(vm, Hit(vm.pc, 'c', addr, old, new))
+
+    def hit(self, vm, hit: Hit):
+        self.hits.append(hit)
+        if len(self.hits) > MAX_HITS:
+            del self.hits[:len(self.hits) - MAX_HITS]
+        if self.verbose and vm.live_output:
+            print(f'\033[95mwatch: {hit}\033[0m', flush=True)
+
+    def summary(self) -> list[str]:
+        return [
+            f'{start}-{end - 1} ({format_kinds(mask)})' if end - start > 1
+            else f'{start} ({format_kinds(mask)})'
+            for (start, end), mask in self.watches.items()
+        ]
@@ -0,0 +1,219 @@
+'''Persistent map of the game world, stored per binary.
+
+Records every explored location with its description, exits and items, and
+keeps an all-pairs table of the first move along a shortest path between any
+two locations (one BFS per location). Exploration which adds rooms or exits
+only marks the table stale, and it is rebuilt once on the next route lookup,
+however many updates came before. Walking directions to a room are then read
+off that table in O(path length).
+'''
+import argparse
+import json
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from basevm import CACHE_ROOT
+
+WORLD_DIR = CACHE_ROOT / 'world'
+
+
+def room_title(desc: str) -> str | None:
+    m = re.search(r'== (.*?) ==', desc)
+    return m.group(1) if m else None
+
+
+def room_items(desc: str) -> list[str]:
+    m = re.search(r'\nThings of interest here:\n(.*?)\n\n', desc, re.DOTALL)
+    return re.findall(r'- (.*)', m.group(1)) if m else []
+
+
+@dataclass
+class WorldGraph:
+    binary_hash: str | None = None
+    descs: dict[int, str] = field(default_factory=dict)
+    # location => {move: destination}
+    edges: dict[int, dict[str, int]] = field(default_factory=dict)
+    # item name => location where it was first seen
+    items: dict[str, int] = field(default_factory=dict)
+    # location => {destination: first move of a shortest path}
+    next_move: dict[int, dict[int, str]] = field(default_factory=dict)
+    stale: bool = False  # next_move needs rebuilding
+
+    @property
+    def path(self) -> Path | None:
+        if self.binary_hash is None:
+            return None
+        return WORLD_DIR / f'{self.binary_hash}.json'
+
+    def title(self, loc: int) -> str:
+        return room_title(self.descs.get(loc, '')) or str(loc)
+
+    def update(
+        self,
+        edges: dict[int, list[tuple[int, str]]],
+        descs: dict[int, str],
+    ) -> int:
+        '''Merge the results of an exploration, returning how many locations
+        were new. Shortest paths are marked stale only if the graph changed.'''
+
+        new = len(set(descs) - set(self.descs))
+        changed = new > 0
+        self.descs |= descs
+        for loc, desc in descs.items():
+            for item in room_items(desc):
+                if item not in self.items:
+                    self.items[item] = loc
+                    changed = True
+        for src, targets in edges.items():
+            moves = self.edges.setdefault(src, {})
+            for dst, move in targets:
+                if moves.get(move) != dst:
+                    moves[move] = dst
+                    changed = True
+
+        if changed:
+            self.stale = True
+            self.save()
+        return new
+
+    def build_paths(self):
+        '''BFS from every location, recording the first move taken towards
+        each reachable destination'''
+
+        self.next_move = {}
+        for src in self.edges:
+            first: dict[int, str] = {}
+            q = deque()
+            for move, dst in self.edges[src].items():
+                if dst != src and dst not in first:
+                    first[dst] = move
+                    q.append(dst)
+            while q:
+                loc = q.popleft()
+                for dst in self.edges.get(loc, {}).values():
+                    if dst != src and dst not in first:
+                        first[dst] = first[loc]
+                        q.append(dst)
+            self.next_move[src] = first
+        self.stale = False
+
+    def drop_edge(self, src: int, move: str):
+        '''Forget a move which no longer leads where it was recorded to, and
+        mark shortest paths stale. The graph on disk is left alone, since the
+        move may only behave differently in the current game state.'''
+
+        self.edges.get(src, {}).pop(move, None)
+        self.stale = True
+
+    def find(self, room: str | int) -> list[int]:
+        '''Locations matching a location id or (case-insensitive) room title'''
+
+        if isinstance(room, int) or room.isdigit():
+            return [int(room)] if int(room) in self.descs else []
+        return [
+            loc for loc in self.descs
+            if self.title(loc).lower() == room.lower()
+        ]
+
+    def route(self, src: int, dst: int) -> list[str] | None:
+        '''Moves along a shortest path from src to dst (None if unreachable)'''
+
+        if self.stale:
+            self.build_paths()
+        moves = []
+        loc = src
+        while loc != dst:
+            move = self.next_move.get(loc, {}).get(dst)
+            if move is None:
+                return None
+            moves.append(move)
+            loc = self.edges[loc][move]
+        return moves
+
+    def route_to(self, src: int, room: str | int) -> list[str] | None:
+        '''Moves to the nearest location matching a room title or id'''
+
+        routes = [
+            r for dst in self.find(room)
+            if (r := self.route(src, dst)) is not None
+        ]
+        return min(routes, key=len, default=None)
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        tmp.write_text(
+            json.dumps({
+                'descs': self.descs,
+                'edges': self.edges,
+                'items': self.items,
+            })
+        )
+        tmp.replace(self.path)
+
+    @classmethod
+    def load(cls, binary_hash: str | None) -> 'WorldGraph':
+        world = cls(binary_hash)
+        if world.path is None or not world.path.exists():
+            return world
+
+        data = json.loads(world.path.read_text())
+        world.descs = {int(loc): d for loc, d in data['descs'].items()}
+        world.edges = {
+            int(src): {move: int(dst)
+                       for move, dst in moves.items()}
+            for src, moves in data['edges'].items()
+        }
+        world.items = data.get('items', {})
+        world.stale = True
+        return world
+
+
+_worlds: dict[str | None, WorldGraph] = {}
+
+
+def world_graph(binary_hash: str | None) -> WorldGraph:
+    '''Return the world graph for a binary, loading it from disk once'''
+
+    if binary_hash not in _worlds:
+        _worlds[binary_hash] = WorldGraph.load(binary_hash)
+    return _worlds[binary_hash]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument('src', nargs='?', help='Starting room (title or id)')
+    parser.add_argument('dst', nargs='?', help='Destination room (title or id)')
+    args = parser.parse_args()
+
+    from vm import file_hash
+    world = world_graph(file_hash(args.file))
+    if not world.descs:
+        print('No world graph yet, run solve_all.py first')
+        return
+
+    if args.src is None:
+        print(f'{len(world.descs)} locations, {len(world.items)} items')
+        for loc in sorted(world.descs):
+            exits = ', '.join(
+                f'{move} => {dst}' for move, dst in world.edges[loc].items()
+            ) if loc in world.edges else ''
+            print(f'{loc:>5}  {world.title(loc):<24} {exits}')
+        return
+
+    for src in world.find(args.src):
+        moves = world.route_to(src, args.dst)
+        route = ';'.join(moves) if moves is not None else 'unreachable'
+        print(f'{src:>5}  {route}')
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
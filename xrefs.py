@@ -0,0 +1,203 @@
+'''Cross-reference index of calls, jumps and memory reads/writes.
+
+Static references are the constant operands of the instructions at the
+boundaries found by the shared control-flow analysis (see
+disassembler.instruction_starts), so code and data are told apart the same way
+as in the disassembler. References through registers can be merged in from an
+execution profile recorded with ProfilingVM.
+
+The game never rewrites its code once booted, so the index is cached per
+binary rather than per memory image, and stays valid as the game state
+changes. Dynamic references are also kept per binary, apart from the cached
+index, and are merged back in whenever the index is rebuilt.
+'''
+import argparse
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import override
+
+from basevm import OPCODES, is_reg, memory_hash, read_instruction
+from disassembler import format_instruction_plain, instruction_starts
+from vm import VM
+
+# index of the operand holding the referenced address for each opcode
+TARGET_ARG = {
+    'call': 0,
+    'jmp': 0,
+    'jt': 1,
+    'jf': 1,
+    'rmem': 1,
+    'wmem': 0,
+}
+
+CACHE_SIZE = 4
+
+
+@dataclass
+class XrefIndex:
+    # target address => [(source address, kind)]
+    refs: dict[int, list[tuple[int, str]]] = field(default_factory=dict)
+    # source address => [(target address, kind)]
+    targets: dict[int, list[tuple[int, str]]] = field(default_factory=dict)
+    dynamic: set[tuple[int, int, str]] = field(default_factory=set)
+
+    def add(self, src: int, dst: int, kind: str):
+        self.refs.setdefault(dst, []).append((src, kind))
+        self.targets.setdefault(src, []).append((dst, kind))
+
+    def to(self, addr: int, kind: str | None = None) -> list[tuple[int, str]]:
+        '''References to the given address, optionally of a single kind'''
+
+        refs = self.refs.get(addr, [])
+        return [r for r in refs if r[1] == kind] if kind else refs
+
+    def callers(self, addr: int):
+        return [src for src, _ in self.to(addr, 'call')]
+
+    def readers(self, addr: int):
+        return [src for src, _ in self.to(addr, 'rmem')]
+
+    def writers(self, addr: int):
+        return [src for src, _ in self.to(addr, 'wmem')]
+
+    def merge_profile(self, profile: set[tuple[int, str, int]]):
+        '''Merge (source, kind, target) events recorded by ProfilingVM'''
+
+        for src, kind, dst in profile:
+            if (src, dst, kind) not in self.dynamic:
+                self.dynamic.add((src, dst, kind))
+                self.add(src, dst, kind)
+
+
+def build_index(memory: list[int]) -> XrefIndex:
+    index = XrefIndex()
+    for addr in instruction_starts(memory):
+        if (opcode := OPCODES.get(memory[addr])) is None or (
+            argidx := TARGET_ARG.get(opcode.name)
+        ) is None:
+            continue
+        _, args = read_instruction(memory, addr)
+        if argidx < len(args) and not is_reg(target := args[argidx]):
+            index.add(addr, target, opcode.name)
+    return index
+
+
+_cache: OrderedDict[str, XrefIndex] = OrderedDict()
+# binary (or memory image) hash => (source, kind, target) profile events
+_dynamic: dict[str, set[tuple[int, str, int]]] = {}
+
+
+def index_key(memory: list[int], binary_hash: str | None = None) -> str:
+    return binary_hash or memory_hash(memory)
+
+
+def xref_index(
+    memory: list[int],
+    binary_hash: str | None = None,
+) -> XrefIndex:
+    '''Return the xref index for the given binary (or memory image, if the
+    binary is unknown), building it once'''
+
+    key = index_key(memory, binary_hash)
+    if key in _cache:
+        _cache.move_to_end(key)
+    else:
+        _cache[key] = index = build_index(memory)
+        index.merge_profile(_dynamic.get(key, set()))
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return _cache[key]
+
+
+def add_profile(
+    memory: list[int],
+    profile: set[tuple[int, str, int]],
+    binary_hash: str | None = None,
+) -> XrefIndex:
+    '''Keep the dynamic references of a profile for the given binary and
+    merge them into its index'''
+
+    key = index_key(memory, binary_hash)
+    _dynamic.setdefault(key, set()).update(profile)
+    index = xref_index(memory, binary_hash)
+    index.merge_profile(profile)
+    return index
+
+
+class ProfilingVM(VM):
+    '''VM which records the resolved targets of calls, jumps and memory
+    accesses made through registers'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile: set[tuple[int, str, int]] = set()
+
+    @override
+    def execute(self, opcode, args):
+        if (argidx := TARGET_ARG.get(opcode.name)) is not None:
+            if is_reg(target := args[argidx]):
+                self.profile.add((self.pc, opcode.name, self.value(target)))
+        return super().execute(opcode, args)
+
+
+def profile_commands(vm: VM, commands: list[str]):
+    '''Run commands on a profiling copy of the VM, returning its profile'''
+
+    pvm = ProfilingVM.from_snapshot(vm.snapshot())
+    pvm.teleport_call_addr = vm.teleport_call_addr
+    for cmd in commands:
+        pvm.send(cmd)
+    return pvm.profile
+
+
+def print_xrefs(memory: list[int], addr: int, index: XrefIndex | None = None):
+    index = index or xref_index(memory)
+    refs = index.to(addr)
+    if not refs:
+        print(f'no references to {addr}')
+        return
+
+    for src, kind in sorted(refs):
+        opcode, args = read_instruction(memory, src)
+        line = f'{kind:>4} {src:>5}  {format_instruction_plain(opcode, args)}'
+        if (src, addr, kind) in index.dynamic:
+            line += ' (dynamic)'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('addrs', nargs='+', type=int)
+    parser.add_argument('-f', '--file', default='challenge.bin')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Boot from scratch instead of using the boot cache',
+    )
+    parser.add_argument(
+        '-c',
+        '--commands',
+        help='Merge dynamic references from running these commands',
+    )
+    args = parser.parse_args()
+
+    from bootcache import boot_vm
+    vm = boot_vm(args.file, use_cache=not args.no_cache)
+    index = xref_index(vm.memory, vm.binary_hash)
+
+    if args.commands:
+        commands = [cmd.strip() for cmd in args.commands.split(';')]
+        index = add_profile(
+            vm.memory, profile_commands(vm, commands), vm.binary_hash
+        )
+
+    for addr in args.addrs:
+        print(f'\033[93mxrefs to {addr}:\033[0m')
+        print_xrefs(vm.memory, addr, index)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass